@@ -0,0 +1,149 @@
+"""
+Synthetic data for the benchmarks. The size of the data is set on the command line:
+
+    pytest benchmarks --bench-size 4096 --bench-bands 12 --bench-nodata 0.2 --bench-points 100000
+
+Throughput (pixels/s or points/s) and peak memory are reported in the extra info
+of each benchmark, e.g. with --benchmark-json or --benchmark-columns.
+"""
+
+import argparse
+import tracemalloc
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from sklearn.ensemble import RandomForestClassifier
+
+CRS = "EPSG:3067"
+RES = 10
+ORIGIN = (300000, 7000000)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("point-eo benchmarks")
+    group.addoption("--bench-size", type=int, default=1024, help="Raster width and height in pixels")
+    group.addoption("--bench-bands", type=int, default=9, help="Number of raster bands")
+    group.addoption("--bench-nodata", type=float, default=0.1, help="Fraction of nodata (zero) pixels")
+    group.addoption("--bench-points", type=int, default=10000, help="Number of sampled points")
+    group.addoption("--bench-classes", type=int, default=10, help="Number of classes")
+
+
+def make_raster(path, size, n_bands, nodata_fraction=0.0, seed=0, dtype="uint16", descriptions=True):
+    """Random raster where the top rows are nodata, like the edge of a mosaic"""
+    rng = np.random.default_rng(seed)
+    arr = rng.integers(1, 3000, (n_bands, size, size)).astype(dtype)
+    arr[:, : int(size * nodata_fraction)] = 0
+
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=n_bands,
+        dtype=dtype,
+        crs=CRS,
+        transform=from_origin(*ORIGIN, RES, RES),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dst:
+        dst.write(arr)
+        if descriptions:
+            dst.descriptions = tuple(f"band{i}" for i in range(n_bands))
+    return path
+
+
+def make_points(path, size, n_points, n_classes, seed=0):
+    """Random points inside the raster created by make_raster with a 'target' column"""
+    rng = np.random.default_rng(seed)
+    x = ORIGIN[0] + rng.uniform(0, size * RES, n_points)
+    y = ORIGIN[1] - rng.uniform(0, size * RES, n_points)
+    gdf = gpd.GeoDataFrame(
+        {"target": rng.integers(0, n_classes, n_points)},
+        geometry=gpd.points_from_xy(x, y),
+        crs=CRS,
+    )
+    gdf.to_file(path)
+    return path
+
+
+def make_model(n_bands, n_classes, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.integers(1, 3000, (2000, n_bands))
+    y = np.arange(2000) % n_classes
+    return RandomForestClassifier(n_estimators=50, random_state=seed).fit(X, y)
+
+
+def parse_args(module, argv):
+    """Parses command line arguments of a point-eo script"""
+    parser = argparse.ArgumentParser(prog="point-eo")
+    subparsers = parser.add_subparsers(dest="script")
+    module.add_args(subparsers)
+    return parser.parse_args(argv)
+
+
+def peak_memory(func, *args, **kwargs):
+    """Peak memory in MB of the Python and NumPy allocations of one call"""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024**2
+
+
+def report(benchmark, func, *args, pixels=None, points=None, **kwargs):
+    """
+    Adds throughput and peak memory to the results of a finished benchmark.
+    Nothing is measured with --benchmark-disable, where the benchmark has no stats.
+    """
+    if benchmark.disabled or benchmark.stats is None:
+        return
+    mean = benchmark.stats.stats.mean
+    if pixels is not None:
+        benchmark.extra_info["pixels_per_s"] = pixels / mean
+    if points is not None:
+        benchmark.extra_info["points_per_s"] = points / mean
+    benchmark.extra_info["peak_memory_mb"] = peak_memory(func, *args, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def config(request):
+    return {
+        "size": request.config.getoption("--bench-size"),
+        "bands": request.config.getoption("--bench-bands"),
+        "nodata": request.config.getoption("--bench-nodata"),
+        "points": request.config.getoption("--bench-points"),
+        "classes": request.config.getoption("--bench-classes"),
+    }
+
+
+@pytest.fixture(scope="session")
+def raster(tmp_path_factory, config):
+    path = tmp_path_factory.mktemp("data") / "raster.tif"
+    return make_raster(path, config["size"], config["bands"], config["nodata"])
+
+
+@pytest.fixture(scope="session")
+def points(tmp_path_factory, config):
+    path = tmp_path_factory.mktemp("data") / "points.geojson"
+    return make_points(path, config["size"], config["points"], config["classes"])
+
+
+@pytest.fixture(scope="session")
+def model(config):
+    return make_model(config["bands"], config["classes"])
+
+
+@pytest.fixture(scope="session")
+def probabilities(tmp_path_factory, config):
+    """Quantized probability stack like the output of predict"""
+    path = tmp_path_factory.mktemp("data") / "probabilities.tif"
+    return make_raster(
+        path, config["size"], config["classes"], config["nodata"], dtype="uint8", descriptions=False
+    )
@@ -0,0 +1,66 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from point_eo.scripts import predict, sample_raster, postprocess_prediction
+from conftest import RES, parse_args, report
+
+CELL_SIZE = 256 * RES
+
+
+def test_sample_raster(benchmark, raster, points, tmp_path, config):
+    args = parse_args(sample_raster, ["sample_raster",
+                                      "--input", str(points),
+                                      "--input_raster", str(raster),
+                                      "--target", "target",
+                                      "--out_folder", str(tmp_path)])
+    benchmark(sample_raster.main, args)
+    report(benchmark, sample_raster.main, args, points=config["points"])
+
+
+def test_full_inference_numpy(benchmark, raster, model):
+    A = np.asarray(predict.open_raster(raster)[:, :512, :512])
+    benchmark(predict.full_inference_numpy, A, model)
+    report(benchmark, predict.full_inference_numpy, A, model, pixels=A.shape[1] * A.shape[2])
+
+
+def test_create_cell_grid(benchmark, raster, config):
+    Fx = predict.open_raster(raster)
+    benchmark(predict.create_cell_grid, Fx, CELL_SIZE)
+    report(benchmark, predict.create_cell_grid, Fx, CELL_SIZE, pixels=config["size"] ** 2)
+
+
+def test_check_cell(benchmark, raster):
+    Fx = predict.open_raster(raster)
+    cells = predict.create_cell_grid(Fx, CELL_SIZE)
+    cell = cells[len(cells) // 2]
+    benchmark(predict.check_cell, Fx, cell)
+    report(benchmark, predict.check_cell, Fx, cell, pixels=(CELL_SIZE // RES) ** 2)
+
+
+def test_calculate(benchmark, raster, model, tmp_path, config):
+    Fx = predict.open_raster(raster)
+    cells = predict.create_cell_grid(Fx, CELL_SIZE)
+    kwargs = dict(model=model, Fx=Fx, cell_list=cells, out_folder=tmp_path, verbose=0)
+    benchmark.pedantic(predict.calculate, kwargs=kwargs, rounds=3)
+    report(benchmark, predict.calculate, pixels=config["size"] ** 2, **kwargs)
+
+
+@pytest.mark.skipif(shutil.which("gdalbuildvrt") is None, reason="gdalbuildvrt not found")
+def test_merge_folder(benchmark, raster, model, tmp_path, config):
+    Fx = predict.open_raster(raster)
+    cells = predict.create_cell_grid(Fx, CELL_SIZE)
+    patches = tmp_path / "patches"
+    predict.calculate(model, Fx, cells, out_folder=patches, verbose=0)
+    output = tmp_path / "merged.vrt"
+    benchmark(predict.merge_folder, patches, output)
+    report(benchmark, predict.merge_folder, patches, output, pixels=config["size"] ** 2)
+
+
+def test_postprocess_prediction(benchmark, probabilities, tmp_path, config):
+    args = parse_args(postprocess_prediction, ["postprocess_prediction",
+                                               "--input_raster", str(probabilities),
+                                               "--out_folder", str(tmp_path)])
+    benchmark.pedantic(postprocess_prediction.main, args=(args,), rounds=3)
+    report(benchmark, postprocess_prediction.main, args, pixels=config["size"] ** 2)
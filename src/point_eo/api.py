@@ -0,0 +1,53 @@
+"""
+Python API of point-eo. The functions work on in-memory objects (GeoDataFrames,
+DataFrames, NumPy arrays, estimators and xarray DataArrays), so that a
+sample -> train -> predict workflow can run in one process without writing
+intermediate files. The command line scripts are thin wrappers around them.
+
+Example:
+
+    import geopandas as gpd
+    from point_eo import api
+
+    gdf, df = api.sample_points(gpd.read_file("points.geojson"), "raster.tif", "target")
+    dfX, y = api.split_table(df)
+    model = api.fit_model(api.build_rf(), dfX.to_numpy(), y.to_numpy(), dfX.columns)
+    Fx = api.prepare_raster(model, "raster.tif")
+    probabilities = api.predict_array(model, Fx[:, :1000, :1000])
+"""
+
+from point_eo.scripts.sample_raster import FeatureCache, sample_points
+from point_eo.scripts.analysis import (
+    build_rf,
+    build_tpot,
+    cross_validate,
+    fit_model,
+    remove_small_classes,
+    split_table,
+)
+from point_eo.scripts.feature_selection import (
+    cluster_representatives,
+    correlation_clusters,
+    correlation_matrix,
+)
+from point_eo.scripts.tpot_train import compare_with_rf, search_tpot
+from point_eo.utils import (
+    ArrayForest,
+    cap_classes,
+    feature_matrix,
+    load_model,
+    read_training_csv,
+    save_model,
+)
+from point_eo.scripts.predict import (
+    Ensemble,
+    make_cells,
+    merge_folder,
+    open_raster,
+    predict_array,
+    predict_cells,
+    predict_raster,
+    prepare_raster,
+)
+from point_eo.scripts.postprocess_prediction import classify
+from point_eo.scripts.zonal_stats import zonal_stats
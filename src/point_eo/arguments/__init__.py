@@ -0,0 +1,5 @@
+"""
+Command line arguments of the point-eo commands. They are defined apart from the
+scripts, which import them, so that building the parser of a command imports only
+argparse and not the dependencies of the command.
+"""
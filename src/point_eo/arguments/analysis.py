@@ -0,0 +1,178 @@
+"""
+Arguments of the analysis command
+"""
+
+
+def optional_int(value):
+    return None if value.lower() == "none" else int(value)
+
+
+def add_rf_args(parser):
+    parser.add_argument(
+        "--n_estimators",
+        type=int,
+        nargs="+",
+        default=[100],
+        help="The number of trees in the forest. Several values start a search, "
+        "see --search.",
+    )
+    parser.add_argument(
+        "--criterion",
+        type=str,
+        nargs="+",
+        default=["gini"],
+        help="The function to measure the quality of a split. "
+        "{“gini”, “entropy”, “log_loss”}, default=”gini”",
+    )
+    parser.add_argument(
+        "--max_depth",
+        type=optional_int,
+        nargs="+",
+        default=[None],
+        help="The maximum depth of the tree. If None, "
+        "then nodes are expanded until all leaves are pure "
+        "or until all leaves contain less than min_samples_split samples.",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        choices=["grid", "random"],
+        default="grid",
+        help="When the random forest arguments have several values, the "
+        "combinations are cross-validated on the same folds, all of them (grid) "
+        "or --n_iter random ones (random). The results are saved to a "
+        "leaderboard csv and the best model is fitted on all rows. The predictions "
+        "csv and figures are of the best combination, without permutation "
+        "importances. Default grid",
+    )
+    parser.add_argument(
+        "--n_iter",
+        type=int,
+        default=10,
+        help="The number of combinations tried by --search random. Default 10",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=-1,
+        help="The number of parallel (combination, fold) fits of a search. Default -1 "
+        "uses all cores",
+    )
+    return parser
+
+
+def add_args(subparser):
+    parser = subparser.add_parser(
+        name="analysis",
+        description="This program trains a random forest model on a csv dataset and "
+        "prints useful information on model performance and feature importance. "
+        "It takes a csv-file as an input, where the first column "
+        "must be the target variable.",
+    )
+
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="The csv-file containing the training data",
+    )
+    parser.add_argument(
+        "--out_folder",
+        type=str,
+        required=False,
+        default="model_fitting",
+        help="The output folder",
+    )
+    parser.add_argument(
+        "--out_prefix",
+        type=str,
+        required=True,
+        help="The prefix that is added to saved files and figures",
+    )
+    parser.add_argument(
+        "--separator",
+        type=str,
+        required=False,
+        default=";",
+        help="The csv separator character. Default ';'",
+    )
+    parser.add_argument(
+        "--decimal",
+        type=str,
+        required=False,
+        default=",",
+        help="The csv decimal character. Default ','",
+    )
+    parser.add_argument(
+        "--bands",
+        type=str,
+        required=False,
+        default=None,
+        help="File with band names as rows. Only these columns are used as "
+        "features, in this order. See feature_selection --correlation_pruning",
+    )
+    parser.add_argument(
+        "--tpot_model",
+        type=str,
+        required=False,
+        default=None,
+        help="The path to a tpot model definition file, or a model saved by tpot_train "
+        "(.pkl), to be used instead of random forest",
+    )
+    parser.add_argument(
+        "--n_splits",
+        type=int,
+        default=5,
+        help="The number of cross-validation folds. If set as 1, calculates a single "
+        "train-test-split validation. Default 5",
+    )
+    parser.add_argument(
+        "--remove_classes_smaller_than",
+        type=int,
+        required=False,
+        default=None,
+        help="Classes smaller than this value are removed. Default None",
+    )
+    parser.add_argument(
+        "--max_per_class",
+        type=int,
+        required=False,
+        default=None,
+        help="At most this many random rows of each class are used. The rows are "
+        "saved to *_sample_rows.txt. Default None uses all rows",
+    )
+    parser.add_argument(
+        "--sample_seed",
+        type=int,
+        required=False,
+        default=42,
+        help="Random seed of --max_per_class. Default 42",
+    )
+    parser.add_argument(
+        "--no_permutation_importance",
+        default=False,
+        action="store_true",
+        help="If this flag is set, no permutation importances are calculated",
+    )
+    parser.add_argument(
+        "--random_seed",
+        type=int,
+        required=False,
+        default=None,
+        help="Random seed. Set a value for deterministic output.",
+    )
+    parser.add_argument(
+        "--classification_report_fonts", type=str, required=False, default="12,10,10"
+    )
+    parser.add_argument(
+        "--confusion_matrix_fonts", type=str, required=False, default="18,10,18"
+    )
+    parser.add_argument(
+        "--save_permutation_importance", default=False, action="store_true",
+        help="If this flag is set, permutation importances are saved to a file"
+    )
+    parser.add_argument(
+        "--no_plots", default=False, action="store_true",
+        help="If this flag is set, no figures are rendered"
+    )
+    parser = add_rf_args(parser)
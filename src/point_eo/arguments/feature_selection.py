@@ -0,0 +1,141 @@
+"""
+Arguments of the feature_selection command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser(
+        name="feature_selection",
+        description="This program runs different algorithms for comparing feature "
+        "importances. "
+        "It takes a csv-file as an input, where the first column "
+        "must be the target variable."
+    )
+
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="The csv-file containing the training data",
+    )
+    parser.add_argument(
+        "--out_folder",
+        type=str,
+        required=False,
+        default="model_fitting",
+        help="The output folder",
+    )
+    parser.add_argument(
+        "--out_prefix",
+        type=str,
+        required=True,
+        help="The prefix that is added to saved files and figures",
+    )
+    parser.add_argument(
+        "--separator",
+        type=str,
+        required=False,
+        default=";",
+        help="The csv separator character. Default ';'",
+    )
+    parser.add_argument(
+        "--decimal",
+        type=str,
+        required=False,
+        default=",",
+        help="The csv decimal character. Default ','",
+    )
+    parser.add_argument(
+        "--remove_classes_smaller_than",
+        type=int,
+        required=False,
+        default=None,
+        help="Classes smaller than this value are removed. Default None",
+    )
+    parser.add_argument(
+        "--max_per_class",
+        type=int,
+        required=False,
+        default=None,
+        help="At most this many random rows of each class are used. The rows are "
+        "saved to *_sample_rows.txt. Default None uses all rows",
+    )
+    parser.add_argument(
+        "--sample_seed",
+        type=int,
+        required=False,
+        default=42,
+        help="Random seed of --max_per_class. Default 42",
+    )
+    parser.add_argument(
+        "--random_seed",
+        type=int,
+        required=False,
+        default=None,
+        help="Random seed. Set a value for deterministic output.",
+    )
+
+    parser.add_argument(
+        "--correlation_pruning",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Clusters correlated features hierarchically and keeps one feature "
+        "per cluster before any model is fitted. The kept features are saved "
+        "to a file that can be passed to analysis with --bands",
+    )
+    parser.add_argument(
+        "--correlation_method",
+        choices=["spearman", "pearson"],
+        default="spearman",
+        required=False,
+        help="Correlation used in --correlation_pruning. Default 'spearman'",
+    )
+    parser.add_argument(
+        "--correlation_threshold",
+        type=float,
+        required=False,
+        default=0.9,
+        help="Features with an absolute correlation above this value are "
+        "clustered together. Default 0.9",
+    )
+    parser.add_argument(
+        "--correlation_chunk_size",
+        type=int,
+        required=False,
+        default=64,
+        help="Number of columns processed at a time when computing the "
+        "correlation matrix. Default 64",
+    )
+
+    parser.add_argument(
+        "--sequential_feature_selector",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Runs the SequentialFeatureSelector from sklearn. "
+        "Set --direction and --n_features_to_select"
+    )
+    parser.add_argument(
+        "--n_features_to_select",
+        type=int,
+        required=False,
+        default=None,
+        help="parameter n_features_to_select for SequentialFeatureSelector"
+    )
+    parser.add_argument(
+        "--direction",
+        choices=["forward", "backward"],
+        default="forward",
+        required=False,
+        help="parameter direction for SequentialFeatureSelector"
+    )
+
+    parser.add_argument(
+        "--logistic_regression_coefficients",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Fits a logistic regression model to the data and saves the "
+        "coefficients for evaluating feature correlation on classification odds"
+    )
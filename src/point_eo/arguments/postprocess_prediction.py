@@ -0,0 +1,37 @@
+"""
+Arguments of the postprocess_prediction command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("postprocess_prediction")
+
+    parser.add_argument("--input_raster", type=str, required=True)
+    parser.add_argument("--out_folder", type=str, required=True)
+    parser.add_argument(
+        "--label_map",
+        type=str,
+        help="Class names, one per line. By default the band descriptions of the "
+        "input are used if set",
+    )
+    parser.add_argument(
+        "--cmap",
+        type=str,
+        default="tab20",
+        help="Matplotlib colormap of the color table of S and the QGIS color map",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=1024,
+        help="Blocks of block_size x block_size pixels are processed in parallel. "
+        "Rounded to a multiple of 256",
+    )
+    parser.add_argument("--n_jobs", type=int, default=-1)
+    parser.add_argument(
+        "--crs",
+        type=str,
+        required=False,
+        default="EPSG:3067",
+        help="CRS of the outputs if the input has none",
+    )
@@ -0,0 +1,202 @@
+"""
+Arguments of the predict command
+"""
+
+
+# Uncertainty measures computed during inference
+UNCERTAINTY = ["entropy", "margin", "variance"]
+
+
+def cell_size_type(value):
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("predict")
+    parser.add_argument(
+        "--model",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Location of pickled model. With several models, all of them are run "
+        "on each cell that is read, see --combine",
+    )
+
+    parser.add_argument(
+        "--weights",
+        type=float,
+        nargs="+",
+        required=False,
+        help="Weights of the models in the ensemble, in the order of --model. "
+        "Default is equal weights",
+    )
+
+    parser.add_argument(
+        "--combine",
+        choices=["mean", "stack"],
+        default="mean",
+        help="With several models, 'mean' writes the weighted average of the class "
+        "confidences and 'stack' the confidences of each model. In the cell mode "
+        "'stack' writes a vrt for each model",
+    )
+
+    parser.add_argument(
+        "--ensemble_band",
+        choices=["entropy", "disagreement"],
+        required=False,
+        help="Adds a band with the entropy of the weighted average confidences "
+        "or the weighted share of models disagreeing with its top class",
+    )
+
+    parser.add_argument(
+        "--input_raster",
+        type=str,
+        required=True,
+        help="The input raster to be classified",
+    )
+
+    parser.add_argument(
+        "--cell_size",
+        type=cell_size_type,
+        required=False,
+        help="The raster is split up to smaller blocks of cell_size X "
+        "cell_size. Use as large value as your memory permits. "
+        "'auto' chooses the cell size and --n_jobs from --memory_budget. "
+        "Required unless --dask_scheduler is set.",
+    )
+
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        required=False,
+        default=None,
+        help="Memory in MB available for --cell_size auto. "
+        "Default is half of the available memory",
+    )
+
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of cells processed in parallel. Default 1, or chosen "
+        "automatically with --cell_size auto",
+    )
+
+    parser.add_argument(
+        "--cell_buffer",
+        "--block_buffer",
+        type=int,
+        required=False,
+        default=None,
+        help="Deprecated. Cells are read as exact pixel windows. Models that use "
+        "spatial context declare their halo in pixels, see --halo",
+    )
+
+    parser.add_argument(
+        "--halo",
+        type=int,
+        required=False,
+        default=None,
+        help="Pixels of context read around each cell and discarded after "
+        "inference. Default is the halo_ attribute of the model, 0 for models "
+        "predicting each pixel from its own bands",
+    )
+
+    parser.add_argument(
+        "--uncertainty",
+        choices=UNCERTAINTY,
+        nargs="+",
+        required=False,
+        help="Uncertainty measures computed from the class confidences during "
+        "inference: entropy, margin between the two highest confidences and "
+        "variance of the top class across the trees of a random forest. Saved as "
+        "8-bit bands to a separate _U raster",
+    )
+
+    parser.add_argument(
+        "--previous",
+        type=str,
+        required=False,
+        help="Manifest (_manifest.json) of a previous run. Cells whose input has "
+        "not changed reuse the outputs of the previous run, compared with checksums "
+        "of the cells or, with --changed_area, by location",
+    )
+
+    parser.add_argument(
+        "--changed_area",
+        type=str,
+        required=False,
+        help="Vector file of the areas where the raster has changed since the "
+        "--previous run. Only cells intersecting it are read and predicted",
+    )
+
+    parser.add_argument(
+        "--bit_depth",
+        type=int,
+        required=False,
+        default=8,
+        help="Output confidence raster is quantized to this range. "
+        "If bit depth is 8, values range from 0-255.",
+    )
+
+    parser.add_argument(
+        "--extent",
+        type=str,
+        required=False,
+        help="Providing an extent geometry makes processing faster as "
+        "areas outside extent are not calculated. If not provided, "
+        "calculation starts by finding empty cells.",
+    )
+    parser.add_argument(
+        "--calculate_empty",
+        action="store_true",
+        help="Passing this argument calculates all empty cells. "
+        "Useful ff extent is not provided and the raster is not rectangular",
+    )
+
+    parser.add_argument("--out_folder", type=str, required=True, help="Output folder")
+
+    parser.add_argument(
+        "--start_index",
+        type=int,
+        required=False,
+        help="Starts processing from here in case of a crash.",
+    )
+    parser.add_argument(
+        "--crs", type=str, required=False, default="EPSG:3067", help="CRS for outputs"
+    )
+
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Processes the --n_jobs parallel cells in separate processes instead "
+        "of threads. Every process memory-maps the model file. Random forests are "
+        "first converted to flat node arrays (point_eo.utils.ArrayForest) that the "
+        "processes share, at the cost of slower inference per process.",
+    )
+
+    parser.add_argument(
+        "--dask_scheduler",
+        type=str,
+        required=False,
+        default=None,
+        help="Predicts on a dask cluster instead of in cells. Give the address of "
+        "the scheduler, or 'local' to start a local cluster with --n_jobs workers. "
+        "The output is a single GeoTIFF in --out_folder",
+    )
+
+    parser.add_argument(
+        "--profile_log",
+        type=str,
+        required=False,
+        default=None,
+        help="Saves the time spent in each stage, bytes read and written and pixel "
+        "count of every cell to this file. A .csv suffix writes csv, others JSON lines",
+    )
+
+    parser.add_argument(
+        "--verbose", type=int, default=1, help="Set to 2 if you want everything to be printed. Default 1"
+    )
@@ -0,0 +1,64 @@
+"""
+Arguments of the sample_raster command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("sample_raster")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--input_raster", type=str, required=True)
+    parser.add_argument("--target", type=str, help="target column")
+    parser.add_argument(
+        "--rename_target", type=str, help="target column is renamed to this"
+    )
+    parser.add_argument(
+        "--band_names", type=str, default=None, help="file with band names as rows"
+    )
+    parser.add_argument(
+        "--dropna",
+        type=int,
+        default=None,
+        help="drops rows with all values as this value",
+    )
+    parser.add_argument("--out_prefix", type=str, default="")
+    parser.add_argument("--out_folder", type=str, default=".")
+    parser.add_argument("--shp", action="store_true")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Folder for caching sampled values. Points sampled before from "
+        "the same raster are read from the cache",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=1024,
+        help="Maximum size of the cache in MB. Least recently used entries are removed",
+    )
+    parser.add_argument(
+        "--max_per_class",
+        type=int,
+        default=None,
+        help="Sample at most this many random points of each class. The rows of the "
+        "selected points are saved to *_sample_rows.txt",
+    )
+    parser.add_argument(
+        "--thin_distance",
+        type=float,
+        default=None,
+        help="Keep one random point of each class in each grid cell of this size "
+        "(in map units) before --max_per_class",
+    )
+    parser.add_argument(
+        "--sample_seed",
+        type=int,
+        default=42,
+        help="Random seed of --max_per_class and --thin_distance",
+    )
+    parser.add_argument(
+        "--cache_checksum",
+        action="store_true",
+        help="Identify the raster by a checksum of its content instead of its "
+        "modification time",
+    )
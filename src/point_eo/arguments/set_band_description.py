@@ -0,0 +1,9 @@
+"""
+Arguments of the set_band_description command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("set_band_description")
+    parser.add_argument("--input_raster", help="path to geotiff")
+    parser.add_argument("--label_map", help="path to file with class names")
@@ -0,0 +1,137 @@
+"""
+Arguments of the tpot_train command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("tpot_train")
+    parser.add_argument(
+        "--input", type=str, required=True, help="csv for model training"
+    )
+
+    parser.add_argument("--out_folder", type=str, required=True, help="output folder")
+
+    parser.add_argument(
+        "--out_prefix", type=str, required=True, help="output file prefix"
+    )
+
+    parser.add_argument("--generations", type=int, required=True, help="generations")
+
+    parser.add_argument(
+        "--population_size", type=int, required=True, help="population size"
+    )
+
+    parser.add_argument(
+        "--scoring", type=str, required=False, default="accuracy", help="scoring"
+    )
+
+    parser.add_argument(
+        "--sep", type=str, required=False, default=",", help="csv separator"
+    )
+
+    parser.add_argument(
+        "--decimal", type=str, required=False, default=".", help="decimal separator"
+    )
+
+    parser.add_argument(
+        "--max_time",
+        type=float,
+        required=False,
+        default=None,
+        help="Maximum time of the search in minutes. The best pipeline found so far "
+        "is used when the time runs out",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the search from the checkpoint in out_folder. The state of "
+        "the search is saved to {out_prefix}_checkpoint.json after every generation "
+        "and the best pipeline so far to {out_prefix}_checkpoint.py",
+    )
+
+    parser.add_argument(
+        "--successive_halving",
+        action="store_true",
+        help="Search on growing stratified subsamples of the rows, promoting the best "
+        "pipelines to the next subsample and finally to 5-fold CV on all rows",
+    )
+
+    parser.add_argument(
+        "--min_fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of the rows in the first subsample of --successive_halving",
+    )
+
+    parser.add_argument(
+        "--eta",
+        type=int,
+        default=3,
+        help="Growth factor of the subsamples and reduction factor of the population "
+        "in --successive_halving",
+    )
+
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=-1,
+        help="Number of parallel jobs of the search and of the final comparison of "
+        "the folds. Default -1 uses all cores",
+    )
+
+    parser.add_argument(
+        "--no_baseline",
+        action="store_true",
+        help="Skip the random forest baseline of the final comparison",
+    )
+
+    parser.add_argument(
+        "--baseline_predictions",
+        type=str,
+        required=False,
+        help="Predictions csv of an earlier analysis run on the same input, used as "
+        "the baseline instead of cross-validating a random forest again",
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        required=False,
+        help="Folder for caching the predictions of the folds of the final "
+        "comparison, so that a rerun does not fit them again. Off by default. "
+        "Entries are never removed, so the folder grows with every pipeline, "
+        "input and fold; delete it when no longer needed",
+    )
+
+    parser.add_argument(
+        "--no_export",
+        action="store_true",
+        help="Do not export the pipeline as a Python script. The fitted pipeline is "
+        "always saved as {out_prefix}_acc*_model.pkl for predict",
+    )
+
+    parser.add_argument(
+        "--remove_classes_smaller_than",
+        type=int,
+        required=False,
+        default=None,
+        help="Classes smaller than this value are removed. Default None",
+    )
+
+    parser.add_argument(
+        "--max_per_class",
+        type=int,
+        required=False,
+        default=None,
+        help="At most this many random rows of each class are used. The rows are "
+        "saved to {out_prefix}_sample_rows_*.txt. Default None uses all rows",
+    )
+
+    parser.add_argument(
+        "--sample_seed",
+        type=int,
+        required=False,
+        default=42,
+        help="Random seed of --max_per_class. Default 42",
+    )
@@ -0,0 +1,77 @@
+"""
+Arguments of the zonal_stats command
+"""
+
+
+def add_args(subparser):
+    parser = subparser.add_parser("zonal_stats")
+
+    parser.add_argument(
+        "--input_raster",
+        type=str,
+        required=True,
+        help="Classification raster (S) of postprocess_prediction or the class "
+        "confidences (vrt or tif) of predict",
+    )
+    parser.add_argument(
+        "--polygons",
+        type=str,
+        required=True,
+        help="Vector file of the polygons. Where polygons overlap, the pixels are "
+        "counted to the later polygon",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="Output file. A csv file gets the statistics, other vector formats "
+        "(e.g. .gpkg) the polygons with the statistics",
+    )
+    parser.add_argument(
+        "--confidence_raster",
+        type=str,
+        required=False,
+        help="Confidence raster (M) of postprocess_prediction. Adds the mean "
+        "confidence of each polygon",
+    )
+    parser.add_argument(
+        "--nodata",
+        type=int,
+        required=False,
+        help="Value skipped in a class raster without a nodata value, like the S of "
+        "postprocess_prediction, where class 0 and pixels without a prediction are "
+        "both 0. Such a raster needs --confidence_raster or --nodata; -1 counts all "
+        "pixels",
+    )
+    parser.add_argument(
+        "--id_column",
+        type=str,
+        required=False,
+        help="Column of the polygons identifying them in a csv output",
+    )
+    parser.add_argument(
+        "--label_map",
+        type=str,
+        required=False,
+        help="Class names, one per line, in the order of the class indices",
+    )
+    parser.add_argument(
+        "--all_touched",
+        action="store_true",
+        help="Count all pixels touched by a polygon instead of the pixels whose "
+        "center is inside it",
+    )
+    parser.add_argument(
+        "--bit_depth",
+        type=int,
+        default=8,
+        help="Bit depth of integer confidences, used to scale the means to [0, 1]",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=1024,
+        help="Blocks of block_size x block_size pixels are processed in parallel",
+    )
+    parser.add_argument("--n_jobs", type=int, default=-1)
+    parser.add_argument("--crs", type=str, required=False, default="EPSG:3067")
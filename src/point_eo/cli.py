@@ -6,34 +6,69 @@ warnings.filterwarnings(
 )
 
 import argparse
-from point_eo.scripts import sample_raster, analysis, feature_selection, tpot_train, predict, set_band_description, postprocess_prediction
+import importlib
+import sys
 
+# Available commands, the modules implementing them and their help texts.
+# The arguments of a command are in point_eo.arguments and its module is imported
+# only when the command is run, so that small steps such as set_band_description
+# or --help do not pay for importing tpot, dask or GDAL.
+COMMANDS = {
+    "sample_raster": (
+        "point_eo.scripts.sample_raster",
+        "Sample raster values at point locations to a csv",
+    ),
+    "analysis": (
+        "point_eo.scripts.analysis",
+        "Cross-validate and train a model on a csv",
+    ),
+    "feature_selection": (
+        "point_eo.scripts.feature_selection",
+        "Compare feature importances",
+    ),
+    "tpot_train": (
+        "point_eo.scripts.tpot_train",
+        "Search a model with TPOT AutoML",
+    ),
+    "predict": (
+        "point_eo.scripts.predict",
+        "Predict class confidences for a raster",
+    ),
+    "set_band_description": (
+        "point_eo.scripts.set_band_description",
+        "Set band descriptions of a raster",
+    ),
+    "postprocess_prediction": (
+        "point_eo.scripts.postprocess_prediction",
+        "Create classification and confidence rasters from a prediction",
+    ),
+    "zonal_stats": (
+        "point_eo.scripts.zonal_stats",
+        "Aggregate a prediction to polygons",
+    ),
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
-def main():
     parser = argparse.ArgumentParser(prog="point-eo")
     subparsers = parser.add_subparsers(title="Available commands", dest="script")
 
-    sample_raster.add_args(subparsers)
-    analysis.add_args(subparsers)
-    feature_selection.add_args(subparsers)
-    tpot_train.add_args(subparsers)
-    predict.add_args(subparsers)
-    set_band_description.add_args(subparsers)
-    postprocess_prediction.add_args(subparsers)
-
-    args = parser.parse_args()
-
-    if args.script == "sample_raster":
-        sample_raster.main(args)
-    elif args.script == "analysis":
-        analysis.main(args)
-    elif args.script == "feature_selection":
-        feature_selection.main(args)
-    elif args.script == "tpot_train":
-        tpot_train.main(args)
-    elif args.script == "predict":
-        predict.main(args)
-    elif args.script == "set_band_description":
-        set_band_description.main(args)
-    elif args.script == "postprocess_prediction":
-        postprocess_prediction.main(args)
+    # The first positional argument is the command
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+
+    for name, (module_name, help) in COMMANDS.items():
+        if name == command:
+            importlib.import_module(f"point_eo.arguments.{name}").add_args(subparsers)
+        else:
+            subparsers.add_parser(name, help=help)
+
+    args = parser.parse_args(argv)
+
+    if args.script is None:
+        parser.print_help()
+        return
+    module = importlib.import_module(COMMANDS[args.script][0])
+    module.main(args)
@@ -1,13 +1,17 @@
 import os
-import pickle
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
+import multiprocessing
+import time
 
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.inspection import permutation_importance
 from sklearn.metrics import (
@@ -17,36 +21,28 @@ from sklearn.metrics import (
     f1_score,
     precision_score,
 )
-from sklearn.model_selection import StratifiedKFold
+from joblib import Parallel, delayed
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold
 from pathlib import Path
 
-
-def add_rf_args(parser):
-    parser.add_argument(
-        "--n_estimators",
-        type=int,
-        default=100,
-        help="The number of trees in the forest.",
-    )
-    parser.add_argument(
-        "--criterion",
-        type=str,
-        default="gini",
-        help="The function to measure the quality of a split. "
-        "{“gini”, “entropy”, “log_loss”}, default=”gini”",
-    )
-    parser.add_argument(
-        "--max_depth",
-        type=int,
-        default=None,
-        help="The maximum depth of the tree. If None, "
-        "then nodes are expanded until all leaves are pure "
-        "or until all leaves contain less than min_samples_split samples.",
-    )
-    return parser
+from point_eo.arguments.analysis import add_args
+from point_eo.utils import (
+    cap_classes,
+    feature_matrix,
+    load_model,
+    read_training_csv,
+    save_model,
+)
 
 
 def build_tpot(tpot_fname):
+    """
+    The pipeline of a script exported by TPOT, or an unfitted copy of a model
+    saved by tpot_train (.pkl)
+    """
+    if Path(tpot_fname).suffix == ".pkl":
+        return clone(load_model(tpot_fname, mmap_mode=None))
+
     uid = datetime.now().strftime("%Y%m%dT%H%M%S")
     temp_module_name = Path(f"model{uid}.py")
 
@@ -75,16 +71,175 @@ def build_tpot(tpot_fname):
     return vals["exported_pipeline"]
 
 
-def build_rf(args):
+def build_rf(n_estimators=100, criterion="gini", max_depth=None):
     rf = RandomForestClassifier(
-        n_estimators=args.n_estimators,
-        criterion=args.criterion,
-        max_depth=args.max_depth,
+        n_estimators=n_estimators,
+        criterion=criterion,
+        max_depth=max_depth,
         n_jobs=-1,
     )
     return rf
 
 
+def rf_configs(rf_grid, search="grid", n_iter=10, random_state=None):
+    """
+    Random forest parameter combinations of `rf_grid`, a dict of lists of values
+    of the build_rf arguments: all of them, or `n_iter` random ones without
+    repetition.
+    """
+    if search == "random":
+        return list(ParameterSampler(rf_grid, n_iter, random_state=random_state))
+    return list(ParameterGrid(rf_grid))
+
+
+def fit_fold(params, X, y, train, test):
+    """Fits a single-threaded random forest on one fold. Returns the predictions
+    of the test rows and the fit time in seconds."""
+    model = build_rf(**params).set_params(n_jobs=1)
+    t0 = time.perf_counter()
+    model.fit(X[train], y[train])
+    seconds = time.perf_counter() - t0
+    return model.predict(X[test]), seconds
+
+
+def search_rf(X, y, configs, folds, n_jobs=-1):
+    """
+    Cross-validates the random forest parameter combinations `configs` on the
+    same `folds`. All (combination, fold) fits run in parallel in `n_jobs`
+    processes that share the data.
+
+    Returns the leaderboard, one row per combination with the scores of the
+    pooled predictions of the folds and their standard deviation over the
+    folds, best weighted F1 first, and the pooled predictions of each
+    combination in the order of the folds. The index of the leaderboard is the
+    position of the combination in `configs`.
+    """
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_fold)(params, X, y, train, test)
+        for params in configs
+        for train, test in folds
+    )
+
+    scorers = {
+        "accuracy": accuracy_score,
+        "precision": lambda a, b: precision_score(a, b, zero_division=0, average="weighted"),
+        "f1_weighted": lambda a, b: f1_score(a, b, zero_division=0, average="weighted"),
+        "f1_macro": lambda a, b: f1_score(a, b, zero_division=0, average="macro"),
+    }
+    rows = []
+    predictions = []
+    y_true = np.concatenate([y[test] for _, test in folds])
+    for i, params in enumerate(configs):
+        fold_results = results[i * len(folds) : (i + 1) * len(folds)]
+        y_pred = np.concatenate([pred for pred, _ in fold_results])
+        predictions.append(y_pred)
+        row = {key: params[key] for key in sorted(params)}
+        for name, score in scorers.items():
+            row[name] = score(y_true, y_pred)
+            row[f"{name}_std"] = np.std(
+                [score(y[test], pred) for (_, test), (pred, _) in zip(folds, fold_results)]
+            )
+        row["fit_seconds"] = sum(seconds for _, seconds in fold_results)
+        rows.append(row)
+
+    leaderboard = pd.DataFrame(rows).sort_values(
+        "f1_weighted", ascending=False, kind="stable"
+    )
+    leaderboard.insert(0, "rank", np.arange(1, len(leaderboard) + 1))
+    if "max_depth" in leaderboard:
+        # None (unlimited depth) is missing, not a float column
+        leaderboard["max_depth"] = leaderboard["max_depth"].astype("Int64")
+    return leaderboard, predictions
+
+
+def split_table(df):
+    """Splits a training table to features and target. The first column is the target."""
+    return df.iloc[:, 1:], df.iloc[:, 0]
+
+
+def remove_small_classes(dfX, dfY, min_size):
+    """Removes the rows of classes smaller than `min_size`.
+    Returns the remaining features and target and the removed classes."""
+    counts = dfY.value_counts()
+    drop_classes = counts[counts < min_size].index.values
+    keep = ~dfY.isin(drop_classes)
+    return dfX.loc[keep, :], dfY.loc[keep], drop_classes
+
+
+def cross_validate(
+    build_model,
+    X,
+    y,
+    feature_names=None,
+    n_splits=5,
+    random_seed=None,
+    permutation_importances=True,
+    folds=None,
+):
+    """
+    Stratified k-fold cross-validation. `build_model` is called without arguments
+    to create a new model for each fold. `folds` are the (train, test) row
+    indices of the folds, by default from a shuffled StratifiedKFold.
+
+    Returns the true and predicted labels of all folds, the permutation importances
+    in long form (None if not calculated) and the model of the last fold.
+    """
+    if feature_names is None:
+        feature_names = [f"band{i}" for i in range(X.shape[1])]
+
+    if folds is None:
+        skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_seed)
+        folds = skf.split(X, y)
+
+    y_true = []
+    y_pred = []
+    dfs = []
+    for i, (train, test) in enumerate(folds):
+        X_train = X[train, :]
+        X_test = X[test, :]
+        y_train = y[train]
+        y_test = y[test]
+
+        logging.info(f"\nFold {i}:")
+        model = build_model()
+        model.fit(X_train, y_train)
+
+        acc, prec, f1 = evaluate_rf(model, X_test, y_test)
+
+        y_pred_fold = model.predict(X_test)
+        y_true = np.concatenate((y_true, y_test))
+        y_pred = np.concatenate((y_pred, y_pred_fold))
+
+        if not permutation_importances:
+            continue
+
+        # Calculate permutation importance
+        result = permutation_importance(
+            model,
+            X_test,
+            y_test,
+            n_repeats=10,
+            random_state=42,
+            n_jobs=-1,
+            scoring="f1_weighted",
+        )
+        dfmelt_perm = array_to_longform(result.importances.T, feature_names)
+        dfmelt_perm["fold"] = i
+        dfmelt_perm = dfmelt_perm.rename(columns={"index": "repetition"})
+        dfs.append(dfmelt_perm)
+
+    dfmelt_perm = pd.concat(dfs) if dfs else None
+    return y_true.astype(int), y_pred.astype(int), dfmelt_perm, model
+
+
+def fit_model(model, X, y, feature_names=None):
+    """Fits the final model. The band names let predict read only the used bands."""
+    model.fit(X, y)
+    if feature_names is not None:
+        model.band_names_ = [str(x) for x in feature_names]
+    return model
+
+
 def evaluate_rf(clf, X_test, y_test, confmat=False):
     y_pred = clf.predict(X_test)
     if confmat:
@@ -215,93 +370,35 @@ def confusion_matrixX(
         )
 
 
-def add_args(subparser):
-    parser = subparser.add_parser(
-        name="analysis",
-        description="This program trains a random forest model on a csv dataset and "
-        "prints useful information on model performance and feature importance. "
-        "It takes a csv-file as an input, where the first column "
-        "must be the target variable.",
-    )
+def use_agg():
+    """Initializer of the figure processes: figures are rendered without a display"""
+    matplotlib.use("Agg")
+
+
+def plot_metrics(y_true, y_pred, title, outname, fonts=(12, 10, 10)):
+    classification_reportX(y_true, y_pred, zero_division=0, figsize=(12, 5), fonts=fonts)
+    plt.title(title)
+    plt.savefig(outname)
+    plt.close("all")
+    return outname
 
-    parser.add_argument(
-        "--input",
-        type=str,
-        required=True,
-        help="The csv-file containing the training data",
-    )
-    parser.add_argument(
-        "--out_folder",
-        type=str,
-        required=False,
-        default="model_fitting",
-        help="The output folder",
-    )
-    parser.add_argument(
-        "--out_prefix",
-        type=str,
-        required=True,
-        help="The prefix that is added to saved files and figures",
-    )
-    parser.add_argument(
-        "--separator",
-        type=str,
-        required=False,
-        default=";",
-        help="The csv separator character. Default ';'",
-    )
-    parser.add_argument(
-        "--decimal",
-        type=str,
-        required=False,
-        default=",",
-        help="The csv decimal character. Default ','",
-    )
-    parser.add_argument(
-        "--tpot_model",
-        type=str,
-        required=False,
-        default=None,
-        help="The path to a tpot model definition file to be used instead of random forest",
-    )
-    parser.add_argument(
-        "--n_splits",
-        type=int,
-        default=5,
-        help="The number of cross-validation folds. If set as 1, calculates a single "
-        "train-test-split validation. Default 5",
-    )
-    parser.add_argument(
-        "--remove_classes_smaller_than",
-        type=int,
-        required=False,
-        default=None,
-        help="Classes smaller than this value are removed. Default None",
-    )
-    parser.add_argument(
-        "--no_permutation_importance",
-        default=False,
-        action="store_true",
-        help="If this flag is set, no permutation importances are calculated",
-    )
-    parser.add_argument(
-        "--random_seed",
-        type=int,
-        required=False,
-        default=None,
-        help="Random seed. Set a value for deterministic output.",
-    )
-    parser.add_argument(
-        "--classification_report_fonts", type=str, required=False, default="12,10,10"
-    )
-    parser.add_argument(
-        "--confusion_matrix_fonts", type=str, required=False, default="18,10,18"
-    )
-    parser.add_argument(
-        "--save_permutation_importance", default=False, action="store_true",
-        help="If this flag is set, permutation importances are saved to a file"
-    )
-    parser = add_rf_args(parser)
+
+def plot_confusion(y_true, y_pred, classes, title, outname, fonts=(18, 10, 18)):
+    confusion_matrixX(y_true, y_pred, classes, fonts=fonts)
+    plt.title(title)
+    plt.savefig(outname)
+    plt.close("all")
+    return outname
+
+
+def plot_permutation_importance(dfmelt_perm, n_features, title, outname):
+    plt.figure(figsize=(5, n_features // 3))
+    sns_plot = sns.boxplot(data=dfmelt_perm, x="value", y="variable")
+    plt.title(title)
+    plt.tight_layout()
+    sns_plot.get_figure().savefig(outname)
+    plt.close("all")
+    return outname
 
 
 def main(args):
@@ -342,10 +439,24 @@ def main(args):
     if Path(args.input).suffix == ".shp":
         raise Exception("You are trying to pass a shp file as input")
 
-    df = pd.read_csv(args.input, sep=args.separator, decimal=args.decimal)
+    if args.bands:
+        with open(args.bands) as f:
+            bands = [l.strip() for l in f if l.strip()]
+        header = pd.read_csv(
+            args.input, sep=args.separator, decimal=args.decimal, nrows=0
+        ).columns
+        missing = [b for b in bands if b not in header]
+        if missing:
+            raise Exception(f"Bands {missing} in {args.bands} not found in {args.input}")
+        usecols = [header[0]] + bands
+        logging.info(f"Using {len(bands)} bands from {args.bands}")
+        df = read_training_csv(
+            args.input, sep=args.separator, decimal=args.decimal, usecols=usecols
+        )
+    else:
+        df = read_training_csv(args.input, sep=args.separator, decimal=args.decimal)
 
-    dfX = df.iloc[:, 1:]
-    dfY = df.iloc[:, 0]
+    dfX, dfY = split_table(df)
     feature_names = dfX.columns
 
     # Print column info
@@ -357,6 +468,7 @@ def main(args):
         logging.info(blue + f"{i+1}\t\t{col}" + RESET)
     logging.info("\n")
     logging.info(f"Shape of data table:\nrows: {df.shape[0]}\ncolumns: {df.shape[1]}")
+    logging.info(f"Memory of data table: {df.memory_usage().sum() / 1024**2:.1f} MB")
 
     # If argument 'remove_small_classes' is set as 'True', remove classes smaller than the value
 
@@ -367,14 +479,18 @@ def main(args):
             + f"\nREMOVING CLASSES SMALLER THAN {args.remove_classes_smaller_than} SAMPLES"
             + RESET
         )
-        drop_classes = dfY.value_counts()[
-            dfY.value_counts() < args.remove_classes_smaller_than
-        ].index.values
-        drop_series = ~dfY.isin(drop_classes)
+        dfX, dfY, drop_classes = remove_small_classes(
+            dfX, dfY, args.remove_classes_smaller_than
+        )
         logging.info(drop_classes)
 
-        dfY = dfY.loc[drop_series]
-        dfX = dfX.loc[drop_series, :]
+    if args.max_per_class:
+        logging.info(
+            bold + red + f"\nSAMPLING AT MOST {args.max_per_class} ROWS PER CLASS" + RESET
+        )
+        rows_file = out_folder / f"{out_stem}_sample_rows.txt"
+        dfX, dfY = cap_classes(dfX, dfY, args.max_per_class, args.sample_seed, rows_file)
+        logging.info(f"Kept {len(dfY)} rows, saved to {rows_file}")
 
     logging.info(bold + green + "\nTarget class distribution" + RESET)
     logging.info("label\tcount")
@@ -382,69 +498,71 @@ def main(args):
     logging.info("\n")
 
     # Convert to numpy arrays for processing
-    X = dfX.to_numpy()
+    X = feature_matrix(dfX)
     y = dfY.to_numpy()
 
-    y_true = []
-    y_pred = []
-
-    # Initialize cross-validation
-    skf = StratifiedKFold(
-        n_splits=args.n_splits, shuffle=True, random_state=args.random_seed
-    )
-
     logging.info(bold + red + "\n\n### Starting cross-validation ###\n" + RESET)
 
-    if args.tpot_model:
-        model = build_tpot(args.tpot_model)
-        logging.info(str(model))
+    # The folds are shared by all models
+    skf = StratifiedKFold(n_splits=args.n_splits, shuffle=True, random_state=args.random_seed)
+    folds = list(skf.split(X, y))
+
+    rf_grid = {
+        "n_estimators": args.n_estimators,
+        "criterion": args.criterion,
+        "max_depth": args.max_depth,
+    }
+    configs = rf_configs(rf_grid, args.search, args.n_iter, args.random_seed)
+    if not args.tpot_model and len(configs) > 1:
+        logging.info(
+            bold + green + f"Searching {len(configs)} random forest combinations" + RESET
+        )
+        leaderboard, predictions = search_rf(X, y, configs, folds, n_jobs=args.n_jobs)
+        logging.info(leaderboard.to_string(index=False))
+
+        outname = out_folder / f"{out_stem}_leaderboard.csv"
+        leaderboard.to_csv(outname, index=False)
+        logging.info(green + f"Saved leaderboard to {outname}" + RESET)
+
+        # The outputs below are of the best combination, from the predictions of
+        # the search. Permutation importances need the models of the folds
+        best = configs[leaderboard.index[0]]
+        logging.info(bold + green + f"Best parameters: {best}" + RESET)
+        template = build_rf(**best)
+        y_true = np.concatenate([y[test] for _, test in folds]).astype(int)
+        y_pred = predictions[leaderboard.index[0]].astype(int)
+        dfmelt_perm = None
+        classes = np.unique(y)
     else:
-        logging.info(bold + green + "Random forest parameters:" + RESET)
-        model = build_rf(args)
-        logging.info(str(model.get_params()))
-
-    # Perform cross validation with intermediate outputs
-    dfs = []
-    for i, (train, test) in enumerate(skf.split(X, y)):
-        X_train = X[train, :]
-        X_test = X[test, :]
-        y_train = y[train]
-        y_test = y[test]
-
-        logging.info(blue + f"\nFold {i}:" + RESET)
+        # The model is built once, each fold and the final fit get an unfitted copy
         if args.tpot_model:
-            model = build_tpot(args.tpot_model)
+            template = build_tpot(args.tpot_model)
+            logging.info(str(template))
         else:
-            model = build_rf(args)
-        model.fit(X_train, y_train)
-
-        acc, prec, f1 = evaluate_rf(model, X_test, y_test)
-
-        y_pred_fold = model.predict(X_test)
-        y_true = np.concatenate((y_true, y_test))
-        y_pred = np.concatenate((y_pred, y_pred_fold))
-
-        # Calculate permutation importance
-        result = permutation_importance(
-            model,
-            X_test,
-            y_test,
-            n_repeats=10,
-            random_state=42,
-            n_jobs=-1,
-            scoring="f1_weighted",
+            logging.info(bold + green + "Random forest parameters:" + RESET)
+            template = build_rf(**configs[0])
+            logging.info(str(template.get_params()))
+
+        # Perform cross validation with intermediate outputs
+        y_true, y_pred, dfmelt_perm, model = cross_validate(
+            lambda: clone(template),
+            X,
+            y,
+            feature_names=feature_names,
+            permutation_importances=not args.no_permutation_importance,
+            folds=folds,
         )
-        dfmelt_perm = array_to_longform(result.importances.T, feature_names)
-        dfmelt_perm["fold"] = i
-        dfmelt_perm = dfmelt_perm.rename(columns={"index": "repetition"})
-        dfs.append(dfmelt_perm)
-
-    dfmelt_perm = pd.concat(dfs)
-
-    y_true = y_true.astype(int)
-    y_pred = y_pred.astype(int)
-    classes = model.classes_
-    pred_df = pd.DataFrame({"y_true": y_true, "y_pred": y_pred})
+        classes = model.classes_
+
+    # Rows of the input csv and folds of the predictions, in the order of the folds
+    pred_df = pd.DataFrame(
+        {
+            "y_true": y_true,
+            "y_pred": y_pred,
+            "row": np.concatenate([dfX.index[test] for _, test in folds]),
+            "fold": np.concatenate([np.full(len(test), i) for i, (_, test) in enumerate(folds)]),
+        }
+    )
 
     logging.info(bold + green + f"\nOverall results:")
     logging.info(
@@ -454,57 +572,92 @@ def main(args):
     )
     logging.info(RESET)
 
-    # Plotting reports
-    cr_fonts = tuple(map(int, args.classification_report_fonts.split(",")))
-    cm_fonts = tuple(map(int, args.confusion_matrix_fonts.split(",")))
-
     logging.info(
-        classification_reportX(
-            y_true.astype(int),
-            y_pred.astype(int),
-            zero_division=0,
-            figsize=(12, 5),
-            fonts=cr_fonts,
-        )
+        classification_report(y_true.astype(int), y_pred.astype(int), zero_division=0)
     )
 
-    plt.title(f"Name: {args.out_prefix}\nDataset: {args.input} \nTimestamp: {uid}")
-    outname = out_folder / f"{out_stem}_metrics.png"
-    plt.savefig(outname)
-    logging.info(green + f"Saved classification figure to {outname}" + RESET + "\n")
-
-    confusion_matrixX(y_true, y_pred, classes, fonts=cm_fonts)
-    plt.title(f"Name: {args.out_prefix}\nDataset: {args.input} \nTimestamp: {uid}")
-    outname = out_folder / f"{out_stem}_confusion.png"
-    plt.savefig(outname)
-    logging.info(green + f"Saved confusion matrix to {outname}" + RESET + "\n")
-
+    # Data artifacts are saved before the figures
     outname = out_folder / f"{out_stem}_predictions.csv"
     pred_df.to_csv(outname, index=False)
     logging.info(green + f"Saved predictions to {outname}" + RESET + "\n")
 
-    # Permutation importance
-    plt.figure(figsize=(5, len(feature_names) // 3))
-    sns_plot = sns.boxplot(data=dfmelt_perm, x="value", y="variable")
-    plt.title(f"Name: {args.out_prefix}\nDataset: {args.input} \nTimestamp: {uid}")
-    outname = out_folder / f"{out_stem}_permutation_importance"
-    plt.tight_layout()
-    sns_plot.get_figure().savefig(f"{outname}.png")
-    logging.info(green + f"Saved permutation importance to {outname}.png" + RESET)
-    if args.save_permutation_importance:
-        dfmelt_perm.to_csv(f"{outname}.csv", index=False)
-        logging.info(green + f"Saved permutation importance to {outname}.csv" + RESET)
+    perm_stem = out_folder / f"{out_stem}_permutation_importance"
+    if dfmelt_perm is not None and args.save_permutation_importance:
+        dfmelt_perm.to_csv(f"{perm_stem}.csv", index=False)
+        logging.info(green + f"Saved permutation importance to {perm_stem}.csv" + RESET)
+
+    # Figures are rendered in background processes while the final model is fitted
+    figures = []
+    if not args.no_plots:
+        cr_fonts = tuple(map(int, args.classification_report_fonts.split(",")))
+        cm_fonts = tuple(map(int, args.confusion_matrix_fonts.split(",")))
+        title = f"Name: {args.out_prefix}\nDataset: {args.input} \nTimestamp: {uid}"
+
+        # Forking this process, which has run joblib and OpenMP threads, can
+        # deadlock. The workers are forked from a clean server process that has
+        # imported the plot functions once, or spawned where forkserver is missing
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+        else:
+            context = multiprocessing.get_context("spawn")
+        pool = ProcessPoolExecutor(max_workers=3, mp_context=context, initializer=use_agg)
+        figures.append(
+            (
+                "classification figure",
+                pool.submit(
+                    plot_metrics,
+                    y_true.astype(int),
+                    y_pred.astype(int),
+                    title,
+                    out_folder / f"{out_stem}_metrics.png",
+                    cr_fonts,
+                ),
+            )
+        )
+        figures.append(
+            (
+                "confusion matrix",
+                pool.submit(
+                    plot_confusion,
+                    y_true,
+                    y_pred,
+                    classes,
+                    title,
+                    out_folder / f"{out_stem}_confusion.png",
+                    cm_fonts,
+                ),
+            )
+        )
+        if dfmelt_perm is not None:
+            figures.append(
+                (
+                    "permutation importance",
+                    pool.submit(
+                        plot_permutation_importance,
+                        dfmelt_perm,
+                        len(feature_names),
+                        title,
+                        f"{perm_stem}.png",
+                    ),
+                )
+            )
+        pool.shutdown(wait=False)
 
     # Fit the final model
-    model.fit(X, y)
+    model = fit_model(clone(template), X, y, feature_names)
     outname = out_folder / f"{out_stem}_model.pkl"
-    pickle.dump(model, open(outname, "wb"))
+    save_model(model, outname)
 
     logging.info(f"Saved model to {outname}")
 
     with open(out_folder / f"{out_stem}_label_map.txt", "w") as f:
         f.writelines([str(x) + "\n" for x in model.classes_])
 
+    for name, future in figures:
+        outname = future.result()
+        logging.info(green + f"Saved {name} to {outname}" + RESET)
+
 
 if __name__ == "__main__":
     main()
@@ -2,9 +2,13 @@ from datetime import datetime
 from pathlib import Path
 import logging
 import sys
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+from scipy.stats import rankdata
 
 from sklearn.feature_selection import SequentialFeatureSelector
 from sklearn.ensemble import RandomForestClassifier
@@ -12,94 +16,57 @@ from sklearn.linear_model import LogisticRegressionCV
 from sklearn.inspection import permutation_importance
 from sklearn.model_selection import cross_val_score
 
-def add_args(subparser):
-    parser = subparser.add_parser(
-        name="feature_selection",
-        description="This program runs different algorithms for comparing feature "
-        "importances. "
-        "It takes a csv-file as an input, where the first column "
-        "must be the target variable."
-    )
-
-    parser.add_argument(
-        "--input",
-        type=str,
-        required=True,
-        help="The csv-file containing the training data",
-    )
-    parser.add_argument(
-        "--out_folder",
-        type=str,
-        required=False,
-        default="model_fitting",
-        help="The output folder",
-    )
-    parser.add_argument(
-        "--out_prefix",
-        type=str,
-        required=True,
-        help="The prefix that is added to saved files and figures",
-    )
-    parser.add_argument(
-        "--separator",
-        type=str,
-        required=False,
-        default=";",
-        help="The csv separator character. Default ';'",
-    )
-    parser.add_argument(
-        "--decimal",
-        type=str,
-        required=False,
-        default=",",
-        help="The csv decimal character. Default ','",
-    )
-    parser.add_argument(
-        "--remove_classes_smaller_than",
-        type=int,
-        required=False,
-        default=None,
-        help="Classes smaller than this value are removed. Default None",
-    )
-    parser.add_argument(
-        "--random_seed",
-        type=int,
-        required=False,
-        default=None,
-        help="Random seed. Set a value for deterministic output.",
-    )
-    
-    parser.add_argument(
-        "--sequential_feature_selector",
-        action="store_true",
-        required=False,
-        default=False,
-        help="Runs the SequentialFeatureSelector from sklearn. "
-        "Set --direction and --n_features_to_select"
-    )
-    parser.add_argument(
-        "--n_features_to_select",
-        type=int,
-        required=False,
-        default=None,
-        help="parameter n_features_to_select for SequentialFeatureSelector"
-    )
-    parser.add_argument(
-        "--direction",
-        choices=["forward", "backward"],
-        default="forward",
-        required=False,
-        help="parameter direction for SequentialFeatureSelector"
-    )
-
-    parser.add_argument(
-        "--logistic_regression_coefficients",
-        action="store_true",
-        required=False,
-        default=False,
-        help="Fits a logistic regression model to the data and saves the "
-        "coefficients for evaluating feature correlation on classification odds"
-    )
+from point_eo.arguments.feature_selection import add_args
+from point_eo.utils import cap_classes, feature_matrix, read_training_csv
+
+
+def correlation_matrix(X, method="spearman", chunk_size=64):
+    """Feature correlation matrix computed in blocks of `chunk_size` columns.
+
+    The standardized table is kept as float32 and the matrix is filled block
+    by block, so the temporary memory stays bounded for wide tables.
+    """
+    if method == "spearman":
+        X = rankdata(X, axis=0)
+    n, p = X.shape
+
+    Z = np.empty((n, p), dtype=np.float32)
+    for i in range(0, p, chunk_size):
+        block = np.asarray(X[:, i : i + chunk_size], dtype=np.float64)
+        std = block.std(axis=0)
+        std[std == 0] = np.inf  # constant columns correlate with nothing
+        Z[:, i : i + chunk_size] = (block - block.mean(axis=0)) / std
+
+    corr = np.empty((p, p), dtype=np.float32)
+    for i in range(0, p, chunk_size):
+        for j in range(i, p, chunk_size):
+            block = Z[:, i : i + chunk_size].T @ Z[:, j : j + chunk_size] / n
+            corr[i : i + chunk_size, j : j + chunk_size] = block
+            corr[j : j + chunk_size, i : i + chunk_size] = block.T
+    np.fill_diagonal(corr, 1)
+    return np.clip(corr, -1, 1)
+
+
+def correlation_clusters(corr, threshold=0.9):
+    """Hierarchical (average linkage) clustering on the distance 1 - |r|.
+    Features correlated above `threshold` end up in the same cluster."""
+    if len(corr) < 2:
+        return np.ones(len(corr), dtype=int)
+    dist = 1 - np.abs(corr).astype(np.float64)
+    np.fill_diagonal(dist, 0)
+    Z = linkage(squareform(dist, checks=False), method="average")
+    return fcluster(Z, t=1 - threshold, criterion="distance")
+
+
+def cluster_representatives(corr, labels):
+    """Returns the column index of one representative per cluster: the member with
+    the highest mean absolute correlation to the rest of its cluster."""
+    representatives = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        centrality = np.abs(corr[np.ix_(members, members)]).mean(axis=1)
+        representatives.append(members[np.argmax(centrality)])
+    return np.sort(representatives)
 
 
 def main(args):
@@ -137,7 +104,7 @@ def main(args):
     if Path(args.input).suffix == ".shp":
         raise Exception("You are trying to pass a shp file as input")
 
-    df = pd.read_csv(args.input, sep=args.separator, decimal=args.decimal)
+    df = read_training_csv(args.input, sep=args.separator, decimal=args.decimal)
 
     dfX = df.iloc[:, 1:]
     dfY = df.iloc[:, 0]
@@ -152,6 +119,7 @@ def main(args):
         logging.info(blue + f"{i+1}\t\t{col}" + RESET)
     logging.info("\n")
     logging.info(f"Shape of data table:\nrows: {df.shape[0]}\ncolumns: {df.shape[1]}")
+    logging.info(f"Memory of data table: {df.memory_usage().sum() / 1024**2:.1f} MB")
 
     # If argument 'remove_small_classes' is set as 'True', remove classes smaller than the value
 
@@ -171,15 +139,50 @@ def main(args):
         dfY = dfY.loc[drop_series]
         dfX = dfX.loc[drop_series, :]
 
+    if args.max_per_class:
+        logging.info(
+            bold + red + f"\nSAMPLING AT MOST {args.max_per_class} ROWS PER CLASS" + RESET
+        )
+        rows_file = out_folder / f"{out_stem}_sample_rows.txt"
+        dfX, dfY = cap_classes(dfX, dfY, args.max_per_class, args.sample_seed, rows_file)
+        logging.info(f"Kept {len(dfY)} rows, saved to {rows_file}")
+
     logging.info(bold + green + "\nTarget class distribution" + RESET)
     logging.info("label\tcount")
     logging.info(dfY.value_counts())
     logging.info("\n")
 
     # Convert to numpy arrays for processing
-    X = dfX.to_numpy()
+    X = feature_matrix(dfX)
     y = dfY.astype("category")
 
+    if args.correlation_pruning:
+        logging.info("\n\n### CORRELATION PRUNING ###")
+        logging.info(
+            "%s correlation, threshold %s", args.correlation_method, args.correlation_threshold
+        )
+        corr = correlation_matrix(
+            X, method=args.correlation_method, chunk_size=args.correlation_chunk_size
+        )
+        labels = correlation_clusters(corr, threshold=args.correlation_threshold)
+        keep = cluster_representatives(corr, labels)
+
+        df_clusters = pd.DataFrame({"feature": feature_names, "cluster": labels})
+        df_clusters["representative"] = df_clusters.index.isin(keep)
+        outname = out_folder / f"{out_stem}_correlation_clusters.csv"
+        df_clusters.to_csv(outname, index=False)
+
+        X = np.ascontiguousarray(X[:, keep])
+        feature_names = feature_names[keep]
+        logging.info(f"Kept {len(keep)} of {len(labels)} features:")
+        for i, feature in enumerate(feature_names):
+            logging.info(f"{i+1}\t{feature}")
+
+        outname = out_folder / f"{out_stem}_bands.txt"
+        with open(outname, "w") as f:
+            f.writelines([str(x) + "\n" for x in feature_names])
+        logging.info(green + f"Saved kept features to {outname}" + RESET)
+
     y_true = []
     y_pred = []
     model = RandomForestClassifier()
@@ -1,63 +1,238 @@
 import argparse
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
-import rioxarray
+import rasterio
+from joblib import effective_n_jobs
+from tqdm import tqdm
 
+from point_eo.arguments.postprocess_prediction import add_args
+from point_eo.utils import block_windows
 
-def save_raster(x, name, crs):
-    x.rio.to_raster(name, compress="LZW", crs=crs, tiled=True, windowed=True)
 
+def classify(xds):
+    """Classification (S, index of the most confident class) and confidence
+    (M, its confidence) from a (band, y, x) confidence stack"""
+    S = xds.argmax("band").astype("uint16")
+    M = xds.max("band").astype("uint16")
+    return S, M
 
-def add_args(subparser):
-    parser = subparser.add_parser("postprocess_prediction")
 
-    parser.add_argument("--input_raster", type=str, required=True)
-    parser.add_argument("--out_folder", type=str, required=True)
-    parser.add_argument("--label_map", type=str)
-    parser.add_argument("--crs", type=str, required=False, default="EPSG:3067")
+def classify_array(A, dtype_S="uint16", dtype_M=None):
+    """S and M of a (band, y, x) confidence array, as in classify"""
+    S = A.argmax(axis=0).astype(dtype_S)
+    M = A.max(axis=0)
+    if dtype_M is not None:
+        M = M.astype(dtype_M)
+    return S, M
 
 
-def main(args):
-    input_raster = Path(args.input_raster)
-    out_folder = Path(args.out_folder)
-    out_folder.mkdir(exist_ok=True, parents=True)
+def output_dtypes(n_classes, dtype):
+    """
+    The smallest data types of S and M: S is uint8 for up to 256 classes, and M
+    keeps the data type of the confidences (uint8 for 8-bit predictions)
+    """
+    dtype_S = "uint8" if n_classes <= 256 else "uint16"
+    return dtype_S, dtype
+
+
+def class_colors(n_classes, cmap="tab20"):
+    """RGBA colors of the classes from a matplotlib colormap, (n_classes, 4) uint8"""
+    return (plt.get_cmap(cmap)(np.arange(n_classes)) * 255).astype(np.uint8)
+
 
-    chunk_s = 2**10
-    xds = rioxarray.open_rasterio(
-        args.input_raster,
-        chunks={"band": -1, "x": chunk_s, "y": chunk_s},
-        lock=False,
-        parallel=True,
+def save_qgis_colormap(outname, classes, colors):
+    """QGIS color map file with the class index, RGBA and name on each line"""
+    table = np.column_stack(
+        [np.arange(len(classes)), colors[: len(classes)], np.asarray(classes, dtype=object)]
     )
+    np.savetxt(outname, table, fmt="%s", delimiter=" ")
+
+
+def save_category_names(raster, classes):
+    """
+    Saves the class names as the GDAL category names of a classification raster.
+    GeoTIFF has no tag for them, so GDAL reads them from the .aux.xml file next
+    to the raster, which is written here without opening the raster.
+    """
+    root = ET.Element("PAMDataset")
+    band = ET.SubElement(root, "PAMRasterBand", band="1")
+    names = ET.SubElement(band, "CategoryNames")
+    for name in classes:
+        ET.SubElement(names, "Category").text = str(name)
+    ET.ElementTree(root).write(f"{raster}.aux.xml")
+
+
+def input_class_names(input_raster):
+    """The band descriptions of the confidence stack, or None if not all are set"""
+    with rasterio.open(input_raster) as src:
+        descriptions = src.descriptions
+    if all(descriptions):
+        return list(descriptions)
+    return None
+
+
+class OrderedWriter:
+    """
+    Writes blocks to the output datasets in the order of their indices. Workers
+    finishing out of turn wait for the writer lock until the previous blocks
+    are written, so that the tiles are written sequentially and at most one
+    finished block per worker is held in memory.
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.next = 0
+        self.aborted = False
+        self.lock = threading.Condition()
+
+    def write(self, i, window, arrays):
+        """Writes block `i`. A failed block is passed as None, so that the later
+        blocks are not left waiting for it."""
+        with self.lock:
+            self.lock.wait_for(lambda: self.next == i or self.aborted)
+            if self.aborted:
+                return
+            try:
+                if arrays is not None:
+                    for dst, a in zip(self.datasets, arrays):
+                        dst.write(a, 1, window=window)
+            finally:
+                self.next += 1
+                self.lock.notify_all()
+
+    def abort(self):
+        """Releases the waiting workers without writing their blocks"""
+        with self.lock:
+            self.aborted = True
+            self.lock.notify_all()
+
+
+def postprocess_raster(
+    input_raster,
+    out_S,
+    out_M,
+    block_size=1024,
+    n_jobs=-1,
+    crs=None,
+    class_names=None,
+    cmap="tab20",
+    verbose=1,
+):
+    """
+    Writes the classification (S) and confidence (M) rasters of a confidence
+    stack block by block. Blocks of `block_size` pixels, aligned with the 256
+    pixel tiles of the outputs, are read and classified in `n_jobs` threads,
+    each with its own handle to the input, and written in order. Memory use
+    depends on the block size and the number of workers, not on the raster.
+
+    S gets a color table of the classes from `cmap` and the `class_names` as
+    its category names, and both rasters get band descriptions, when they are
+    created.
+    """
+    with rasterio.open(input_raster) as src:
+        height, width = src.shape
+        n_classes = src.count
+        dtype_S, dtype_M = output_dtypes(n_classes, src.dtypes[0])
+        profile = {
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "count": 1,
+            "crs": src.crs if src.crs is not None else crs,
+            "transform": src.transform,
+            "compress": "LZW",
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+        }
+
+    block_size = max(256, block_size // 256 * 256)
+    windows = list(block_windows(height, width, block_size))
+
+    # Each worker thread reads through its own handle to the input
+    local = threading.local()
+    handles = []
+
+    def read(window):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(input_raster)
+            handles.append(local.src)
+        return local.src.read(window=window)
+
+    with rasterio.open(out_S, "w", dtype=dtype_S, **profile) as dst_S, rasterio.open(
+        out_M, "w", dtype=dtype_M, **profile
+    ) as dst_M:
+        colors = class_colors(n_classes, cmap)
+        dst_S.write_colormap(1, dict(enumerate(map(tuple, colors))))
+        dst_S.set_band_description(1, "class")
+        dst_M.set_band_description(1, "confidence")
+        writer = OrderedWriter([dst_S, dst_M])
+
+        def run(i, window):
+            arrays = None
+            try:
+                arrays = classify_array(read(window), dtype_S, dtype_M)
+            finally:
+                writer.write(i, window, arrays)
+
+        # The workers are finished before the outputs are closed
+        with ThreadPoolExecutor(max_workers=effective_n_jobs(n_jobs)) as pool:
+            futures = [pool.submit(run, i, window) for i, window in enumerate(windows)]
+            try:
+                for future in tqdm(
+                    as_completed(futures), total=len(windows), disable=not verbose
+                ):
+                    future.result()
+            except BaseException:
+                writer.abort()
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+            finally:
+                for src in handles:
+                    src.close()
+
+    if class_names is not None:
+        save_category_names(out_S, class_names)
+    return dtype_S, dtype_M
 
-    S = xds.argmax("band").astype("uint16")
-    M = xds.max("band").astype("uint16")
 
-    save_raster(S, out_folder / f"{input_raster.stem}_S.tif", args.crs)
-    save_raster(M, out_folder / f"{input_raster.stem}_M.tif", args.crs)
-    print("Saved S and M rasters")
+def main(args):
+    input_raster = Path(args.input_raster)
+    out_folder = Path(args.out_folder)
+    out_folder.mkdir(exist_ok=True, parents=True)
 
+    # Class names from the label map, or the band descriptions written by predict
     if args.label_map:
         with open(args.label_map) as f:
-            fwd = {label.strip(): i for i, label in enumerate(f)}
-
-        classes = list(fwd.keys())
+            classes = [label.strip() for label in f if label.strip()]
+    else:
+        classes = input_class_names(input_raster)
+    if classes is not None:
         print(classes)
 
-        cm = plt.get_cmap("tab20")
-
-        def create_qgis_colormap(outname, classes):
-            with open(outname, "w") as f:
-                for i, classname in enumerate(classes):
-                    rgb = list((np.array(cm(i)) * 255).astype(np.uint8))
-                    f.write(str(i) + " ")
-                    f.writelines([str(x) + " " for x in rgb])
-                    f.write(str(classname) + "\n")
+    out_S = out_folder / f"{input_raster.stem}_S.tif"
+    dtype_S, dtype_M = postprocess_raster(
+        input_raster,
+        out_S,
+        out_folder / f"{input_raster.stem}_M.tif",
+        block_size=args.block_size,
+        n_jobs=args.n_jobs,
+        crs=args.crs,
+        class_names=classes,
+        cmap=args.cmap,
+    )
+    print(f"Saved S ({dtype_S}) and M ({dtype_M}) rasters")
 
-        create_qgis_colormap(
-            Path(out_folder) / f"{input_raster.stem}_cmap.txt", classes
+    if classes is not None:
+        save_qgis_colormap(
+            out_folder / f"{input_raster.stem}_cmap.txt",
+            classes,
+            class_colors(len(classes), args.cmap),
         )
 
 
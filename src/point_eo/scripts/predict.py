@@ -2,20 +2,36 @@
 Performs inference on a geotiff, outputs a classification map and confidences
 """
 
+import os
+import csv
+import hashlib
+import json
+import shutil
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 import subprocess
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
 
-import pickle
 import numpy as np
 import shapely
+import rasterio
 import rioxarray
 import xarray as xr
 import geopandas as gpd
 from tqdm import tqdm
 import dask.array as da
 from joblib import Parallel, delayed
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
 
-from rioxarray.exceptions import NoDataInBounds
+
+from point_eo.arguments.predict import UNCERTAINTY, add_args
+from point_eo.utils import ArrayForest, available_memory, load_model, save_model
+
+# Stages of predict_cell that are timed
+STAGES = ["read_s", "check_s", "inference_s", "clip_s", "quantize_s", "write_s"]
 
 
 def new_3d_xda(c, d):
@@ -27,20 +43,11 @@ def new_3d_xda(c, d):
     )
 
 
-def new_2d_xda(c, d):
-    return xr.DataArray(c, coords={"y": d.y, "x": d.x}, dims=("y", "x"))
-
-
 def save_raster(x, name, crs):
     if not da.all(x == da.zeros_like(x)):
         x.rio.to_raster(name, compress="LZW", crs=crs, tiled=True, windowed=True)
 
 
-def batch2img(sample, shape):
-    H, W = shape
-    return sample.reshape(H, W, sample.shape[1]).permute(2, 0, 1)
-
-
 def full_inference_numpy(A, clf):
     # Reshaping
     A0 = np.moveaxis(A, 0, 2)
@@ -57,6 +64,226 @@ def full_inference_numpy(A, clf):
     return C
 
 
+def forest_inference(a, model):
+    """
+    Class probabilities of a random forest for the (pixel, band) array `a` and the
+    variance of each class probability across the trees.
+    """
+    a = np.ascontiguousarray(a, dtype="float32")
+    if isinstance(model, ArrayForest):
+        probas = model.tree_proba(a)
+    else:
+        probas = (tree.predict_proba(a, check_input=False) for tree in model.estimators_)
+    S = np.zeros((len(a), len(model.classes_)))
+    S2 = np.zeros_like(S)
+    n = 0
+    for p in probas:
+        S += p
+        S2 += p * p
+        n += 1
+    P = S / n
+    return P, S2 / n - P * P
+
+
+def is_forest(model):
+    return isinstance(model, (RandomForestClassifier, ExtraTreesClassifier, ArrayForest))
+
+
+def probability_bands(model):
+    """Number of the leading outputs of the model that are class probabilities"""
+    if isinstance(model, Ensemble):
+        if model.combine == "stack":
+            raise Exception("Uncertainty needs class probabilities, use --combine mean")
+        return len(model.class_union_)
+    return len(model.classes_)
+
+
+def full_inference_uncertainty(A, model, measures):
+    """
+    Class confidences and the uncertainty `measures` of a (band, y, x) array,
+    as (class, y, x) and (measure, y, x) arrays. The measures are in [0, 1]:
+    entropy normalized by the log of the number of classes, margin between the
+    two highest confidences and, for random forests, the variance of the
+    confidence of the top class across the trees, multiplied by 4.
+    """
+    ny, nx = A.shape[1:]
+    a = np.moveaxis(A, 0, 2).reshape(ny * nx, -1)
+
+    if "variance" in measures:
+        if not is_forest(model):
+            raise Exception("The variance across trees needs a random forest model")
+        c, var = forest_inference(a, model)
+    else:
+        c = model.predict_proba(a)
+    P = c[:, : probability_bands(model)]
+    n_classes = P.shape[1]
+
+    U = np.zeros((len(P), len(measures)))
+    for j, measure in enumerate(measures):
+        if measure == "entropy" and n_classes > 1:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                U[:, j] = -np.nansum(P * np.log(P), axis=1) / np.log(n_classes)
+        elif measure == "margin":
+            if n_classes > 1:
+                top2 = np.partition(P, -2, axis=1)
+                U[:, j] = top2[:, -1] - top2[:, -2]
+            else:
+                U[:, j] = 1
+        elif measure == "variance":
+            U[:, j] = 4 * var[np.arange(len(P)), P.argmax(axis=1)]
+
+    C = np.moveaxis(c.reshape(ny, nx, -1), 2, 0)
+    U = np.moveaxis(U.reshape(ny, nx, -1), 2, 0)
+    return C, U
+
+
+def model_bands(model):
+    """Band names the model was trained on, or None if the model does not carry them"""
+    names = getattr(model, "band_names_", None)
+    if names is None:
+        names = getattr(model, "feature_names_in_", None)
+    if names is None:
+        return None
+    return [str(x) for x in names]
+
+
+class Ensemble:
+    """
+    Several models predicting the same pixels in one pass. The ensemble looks like
+    a single model to predict: it is fed the bands of all models once and each
+    model gets its own bands from them.
+
+    With `combine="mean"` the output is the weighted average of the class
+    probabilities over the union of the classes of the models. With
+    `combine="stack"` the probabilities of each model follow each other.
+    `extra` appends one band computed from the weighted average: "entropy",
+    normalized to [0, 1], or "disagreement", the weighted share of the models
+    whose top class differs from the top class of the average.
+
+    `classes_` labels the output bands.
+    """
+
+    def __init__(self, models, weights=None, names=None, combine="mean", extra=None):
+        if combine not in ("mean", "stack"):
+            raise Exception(f"Unknown combine '{combine}', use 'mean' or 'stack'")
+        if extra not in (None, "entropy", "disagreement"):
+            raise Exception(f"Unknown extra band '{extra}', use 'entropy' or 'disagreement'")
+        if weights is None:
+            weights = np.ones(len(models))
+        if len(weights) != len(models):
+            raise Exception(f"Got {len(weights)} weights for {len(models)} models")
+
+        self.models = list(models)
+        self.names = list(names) if names is not None else [f"model{i}" for i in range(len(models))]
+        self.combine = combine
+        self.extra = extra
+        self.weights_ = np.asarray(weights, dtype="float64") / np.sum(weights)
+        self.halo_ = max(model_halo(m) for m in self.models)
+
+        # Bands: the union of the bands of the models in order of appearance
+        bands = [model_bands(m) for m in self.models]
+        if all(b is not None for b in bands):
+            self.band_names_ = list(dict.fromkeys(b for names in bands for b in names))
+            self.band_index_ = [
+                np.array([self.band_names_.index(b) for b in names]) for names in bands
+            ]
+        elif all(b is None for b in bands):
+            n_features = {getattr(m, "n_features_in_", None) for m in self.models}
+            if len(n_features) > 1:
+                raise Exception(
+                    "Models without band names must use the same number of bands, "
+                    f"got {sorted(n_features, key=str)}"
+                )
+            self.band_index_ = [slice(None)] * len(self.models)
+        else:
+            raise Exception("Either all or none of the models must carry band names")
+
+        # Classes: the union of the classes of the models
+        self.class_union_ = np.unique(np.concatenate([m.classes_ for m in self.models]))
+        self.class_index_ = [np.searchsorted(self.class_union_, m.classes_) for m in self.models]
+
+        if combine == "mean":
+            labels = list(self.class_union_)
+        else:
+            labels = [f"{name}:{c}" for name, m in zip(self.names, self.models) for c in m.classes_]
+        if extra is not None:
+            labels.append(extra)
+        self.classes_ = np.array(labels, dtype=object if combine == "stack" or extra else None)
+
+    def __repr__(self):
+        members = ", ".join(f"{n} ({w:.2f})" for n, w in zip(self.names, self.weights_))
+        return f"Ensemble({self.combine}: {members})"
+
+    def predict_proba(self, X):
+        probas = [m.predict_proba(X[:, idx]) for m, idx in zip(self.models, self.band_index_)]
+
+        P = np.zeros((len(X), len(self.class_union_)))
+        for p, w, cols in zip(probas, self.weights_, self.class_index_):
+            P[:, cols] += w * p
+        out = [P] if self.combine == "mean" else probas
+
+        if self.extra == "entropy":
+            if len(self.class_union_) > 1:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    H = -np.nansum(P * np.log(P), axis=1)
+                out.append((H / np.log(len(self.class_union_)))[:, None])
+            else:
+                out.append(np.zeros((len(X), 1)))
+        elif self.extra == "disagreement":
+            top = P.argmax(axis=1)
+            D = np.zeros(len(X))
+            for p, w, cols in zip(probas, self.weights_, self.class_index_):
+                D += w * (cols[p.argmax(axis=1)] != top)
+            out.append(D[:, None])
+        return np.hstack(out)
+
+    def output_bands(self):
+        """1-based output bands of each model, and of the extra band, in stack mode"""
+        bands = {}
+        start = 1
+        for name, m in zip(self.names, self.models):
+            bands[name] = list(range(start, start + len(m.classes_)))
+            start += len(m.classes_)
+        if self.extra is not None:
+            bands[self.extra] = [start]
+        return bands
+
+
+def band_indices(input_raster, band_names):
+    """
+    Zero-based positions of `band_names` in the raster, in the order of `band_names`.
+    Names are matched against the band descriptions of the raster and then against
+    the default names band0, band1, ... given by sample_raster.
+    """
+    with rasterio.open(input_raster) as src:
+        descriptions = list(src.descriptions)
+    default_names = [f"band{i}" for i in range(len(descriptions))]
+
+    indices = []
+    for name in band_names:
+        if name in descriptions:
+            indices.append(descriptions.index(name))
+        elif name in default_names:
+            indices.append(default_names.index(name))
+        else:
+            raise Exception(
+                f"Model band '{name}' not found in the band descriptions of {input_raster}"
+            )
+    return indices
+
+
+def open_raster(input_raster, bands=None, chunk_s=2**10):
+    """
+    Opens the raster as a dask backed DataArray. If `bands` is given, only these
+    bands are read from disk, in the given order.
+    """
+    Fx = rioxarray.open_rasterio(input_raster, lock=False)
+    if bands is not None:
+        # Selecting before chunking passes the band indexes to the reader
+        Fx = Fx.isel(band=bands)
+    return Fx.chunk({"band": -1, "x": chunk_s, "y": chunk_s})
+
+
 def create_cell_grid(
     Fx,
     cell_size,
@@ -79,21 +306,64 @@ def create_cell_grid(
 
     return grid_cells
 
-def clip_arr(C_arr, c, Ax, clip_buffer, crs):
-    out_C_buf = new_3d_xda(C_arr, Ax)
-    out_C_buf = out_C_buf.rio.write_crs(crs)
-
-    clipper = c.buffer(-clip_buffer, cap_style=3, join_style=2)
 
-    return out_C_buf.rio.clip([clipper])
+def model_halo(model):
+    """
+    Pixels of spatial context the model needs around each predicted pixel.
+    Models predicting each pixel from its own bands need none; models using
+    spatial context declare it with a `halo_` attribute.
+    """
+    return int(getattr(model, "halo_", 0))
+
+
+def cell_window(Fx, cell, halo=0):
+    """
+    Pixel window of the pixels whose centers are inside the bounds of `cell`.
+    Adjacent cells of create_cell_grid get non-overlapping windows. The window is
+    extended by `halo` pixels where the raster allows, so cells at the edges of the
+    raster get no context from outside it.
+
+    Returns the (y, x) slices of the extended window in the raster and the (y, x)
+    slices of the cell inside the extended window.
+    """
+    minx, miny, maxx, maxy = cell.bounds
+    x = Fx.x.values
+    y = Fx.y.values  # descending
+
+    c0, c1 = np.searchsorted(x, [minx, maxx])
+    r0, r1 = np.searchsorted(-y, [-maxy, -miny])
+    # The grid starts at the center of the last row, which belongs to the first cell,
+    # and ends at the center of the last column when the cells divide the raster evenly
+    if miny <= y[-1]:
+        r1 = len(y)
+    if maxx >= x[-1]:
+        c1 = len(x)
+
+    R0, R1 = max(r0 - halo, 0), min(r1 + halo, len(y))
+    C0, C1 = max(c0 - halo, 0), min(c1 + halo, len(x))
+    outer = (slice(R0, R1), slice(C0, C1))
+    inner = (slice(r0 - R0, r1 - R0), slice(c0 - C0, c1 - C0))
+    return outer, inner
+
+
+def cell_key(Fx, cell):
+    """The pixel window of the cell as [row, column, height, width]"""
+    (ys, xs), _ = cell_window(Fx, cell)
+    return [
+        int(ys.start),
+        int(xs.start),
+        int(ys.stop - ys.start),
+        int(xs.stop - xs.start),
+    ]
 
 
 def check_cell(Fx, cell):
     try:
-        Ax = Fx.rio.clip([cell], from_disk=True)
+        (ys, xs), _ = cell_window(Fx, cell)
+        Ax = Fx[:, ys, xs]
+        if Ax.size == 0:
+            return False
         return not da.all(Ax == da.zeros_like(Ax)).compute()
-    except NoDataInBounds:
-        return False
     except ValueError:
         return False
     except np.core._exceptions._ArrayMemoryError:
@@ -101,68 +371,392 @@ def check_cell(Fx, cell):
         return True
 
 
+@lru_cache(maxsize=None)
+def cached_model(model_file):
+    """The model loaded once per process, memory-mapped"""
+    return load_model(model_file, mmap_mode="r")
+
+
+@contextmanager
+def timed(record, key):
+    """Adds the time spent in the block to record[key]"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[key] = record.get(key, 0) + time.perf_counter() - t0
+
+
+def output_files(out_folder, i):
+    """Output files of cell i: class confidences C and uncertainty U, as absolute paths"""
+    out_folder = Path(out_folder).resolve()
+    return {
+        "C": out_folder / f"C_{i:04d}.tif",
+        "U": out_folder / "uncertainty" / f"U_{i:04d}.tif",
+    }
+
+
+def array_checksum(A):
+    """Checksum of the values, shape and data type of an array"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{A.dtype}{A.shape}".encode())
+    h.update(np.ascontiguousarray(A))
+    return h.hexdigest()
+
+
+def reuse_outputs(previous, out_folder, i):
+    """
+    Links the output files of a cell in a previous run to the files of cell i,
+    copying them if links are not possible. Returns the new files, or None if a
+    previous file is missing.
+    """
+    files = {key: Path(f) for key, f in previous.get("files", {}).items()}
+    if not all(f.exists() for f in files.values()):
+        return None
+    targets = output_files(out_folder, i)
+    for key, f in files.items():
+        try:
+            os.link(f, targets[key])
+        except OSError:
+            shutil.copy2(f, targets[key])
+    return {key: str(targets[key]) for key in files}
+
+
+def predict_cell(
+    model,
+    Fx,
+    c,
+    i,
+    halo=0,
+    bit_depth=8,
+    crs="EPSG:3067",
+    out_folder="predict_output",
+    verbose=2,
+    uncertainty=None,
+    previous=None,
+    check=True,
+):
+    """
+    Predicts a single cell and saves it as C_{i}.tif. The cell is read with `halo`
+    pixels of context, which are sliced off after inference. The `uncertainty`
+    measures are saved as 8-bit bands to uncertainty/U_{i}.tif.
+
+    `previous` is the record of the same cell in a previous run. Its outputs are
+    reused if the checksum of the input is unchanged, or without reading the
+    input if `check` is False.
+
+    Returns a record of the cell with the time spent in each stage in seconds,
+    bytes read and written, pixel count, pixel window, input checksum, absolute
+    paths of the files and whether the previous files were missing.
+    """
+    if isinstance(model, (str, Path)):
+        model = cached_model(str(model))
+
+    record = {"cell": i, "status": "saved"}
+    for key in STAGES:
+        record[key] = 0.0
+    record.update(bytes_read=0, bytes_written=0, pixels=0)
+
+    (ys, xs), (inner_y, inner_x) = cell_window(Fx, c, halo)
+    record["window"] = cell_key(Fx, c)
+    record["checksum"] = None
+    record["files"] = {}
+    # Whether the outputs of the previous run could not be reused because they are missing
+    record["previous_missing"] = False
+    if ys.stop <= ys.start or xs.stop <= xs.start:
+        record["status"] = "no_data"
+        if verbose == 2:
+            print(f"No pixels in {i}")
+        return record
+    record["pixels"] = (inner_y.stop - inner_y.start) * (inner_x.stop - inner_x.start)
+
+    def reuse():
+        with timed(record, "write_s"):
+            files = reuse_outputs(previous, out_folder, i)
+        if files is not None:
+            record["status"] = "reused"
+            record["files"] = files
+            if verbose == 2:
+                print(f"Reused {i}")
+        else:
+            record["previous_missing"] = True
+        return files is not None
+
+    if previous is not None and not check:
+        record["checksum"] = previous.get("checksum")
+        if reuse():
+            return record
+
+    with timed(record, "read_s"):
+        Ax = Fx[:, ys, xs]
+        A = np.asarray(Ax.compute())
+    record["bytes_read"] = A.nbytes
+
+    with timed(record, "check_s"):
+        record["checksum"] = array_checksum(A)
+    if previous is not None and check and previous.get("checksum") == record["checksum"]:
+        if reuse():
+            return record
+
+    with timed(record, "check_s"):
+        empty = not A[:, inner_y, inner_x].any()
+
+    if empty:
+        record["status"] = "empty"
+        if verbose == 2:
+            print(f"Skip empty {i}")
+        return record
+
+    with timed(record, "inference_s"):
+        if uncertainty:
+            C_arr, U_arr = full_inference_uncertainty(A, model, uncertainty)
+        else:
+            C_arr = full_inference_numpy(A, model)
+
+    with timed(record, "clip_s"):
+        out_C = new_3d_xda(C_arr[:, inner_y, inner_x], Ax[:, inner_y, inner_x])
+        out_C = out_C.rio.write_crs(crs)
+        if uncertainty:
+            out_U = new_3d_xda(U_arr[:, inner_y, inner_x], Ax[:, inner_y, inner_x])
+            out_U = out_U.rio.write_crs(crs)
+
+    with timed(record, "quantize_s"):
+        out_C = (out_C * (2**bit_depth - 1)).astype("uint16")
+        if uncertainty:
+            out_U = (out_U * 255).astype("uint8")
+
+    # Written as the band descriptions
+    out_C.attrs["long_name"] = tuple(str(c) for c in model.classes_)
+    if uncertainty:
+        out_U.attrs["long_name"] = tuple(uncertainty)
+
+    files = output_files(out_folder, i)
+    with timed(record, "write_s"):
+        save_raster(out_C, files["C"], crs=crs)
+        if uncertainty:
+            save_raster(out_U, files["U"], crs=crs)
+    for key, f in files.items():
+        if f.exists():
+            record["bytes_written"] += f.stat().st_size
+            record["files"][key] = str(f)
+    if verbose == 2:
+        print(f"SAVED {i}")
+    return record
+
+
 def calculate(
     model,
     Fx,
     cell_list,
     start_index=0,
     global_index = 0,
-    clip_buffer=0,
+    halo=0,
     bit_depth=8,
     crs="EPSG:3067",
     out_folder="predict_output",
     verbose=2,
-    pbar = None
+    pbar = None,
+    n_jobs=1,
+    stats=None,
+    processes=False,
+    uncertainty=None,
+    previous=None,
+    changed_area=None,
 ):
     si = start_index
     i = global_index
     out_folder = Path(out_folder)
     out_folder.mkdir(parents=True, exist_ok=True)
+    if uncertainty:
+        (out_folder / "uncertainty").mkdir(exist_ok=True)
+
+    def reuse_plan(c):
+        # The record of the cell in the previous run, and whether its input is checked
+        if previous is None:
+            return None, True
+        entry = previous.get(tuple(cell_key(Fx, c)))
+        if changed_area is None:
+            return entry, True
+        if changed_area.intersects(c):
+            return None, True
+        return entry, False
+
+    def run(c, i, entry, check):
+        record = predict_cell(
+            model, Fx, c, i, halo, bit_depth, crs, out_folder, verbose, uncertainty,
+            previous=entry, check=check,
+        )
+        if stats is not None:
+            stats.append(record)
+        if pbar:
+            pbar.update(1)
 
-
+    jobs = []
     for c in cell_list:
         if i < si:
-            i += 1
             if pbar:
                 pbar.update(1)
         else:
-            try:
-                Ax = Fx.rio.clip([c], from_disk=True)
-                if not da.all(Ax == da.zeros_like(Ax)).compute():
-                    C_arr = full_inference_numpy(np.asarray(Ax.compute()), model)
-
-                    try:
-                        out_C = clip_arr(C_arr, c, Ax, clip_buffer, crs)
-                    except FileNotFoundError: 
-                        raise Exception("Running out of file handles. You can try continuing the run " \
-                            f"by restarting the script with the parameter --start_index {i-1}." \
-                                "However, it is recommended to make --cell_size larger, deleting the patch folder " 
-                                "and restarting the script."
-                        )
-
-                    out_C = (out_C * (2**bit_depth - 1)).astype("uint16")
-
-                    out_fname = Path(out_folder) / f"C_{i:04d}.tif"
-                    save_raster(out_C, out_fname, crs=crs)
-                    if verbose == 2:
-                        print(f"SAVED {i}")
-                else:
-                    if verbose == 2:
-                        print(f"Skip empty {i}")
-
-            except NoDataInBounds:
-                if verbose == 2:
-                    print(f"NoDataInBounds in {i}")
-            except ValueError:
-                if verbose == 2:
-                    print(f"ValueError in {i}")
+            jobs.append((c, i, *reuse_plan(c)))
+        i += 1
+
+    # Cells are written to separate files, so they can be processed in threads.
+    # Reading and inference release the GIL.
+    if n_jobs == 1:
+        for job in jobs:
+            run(*job)
+    elif processes:
+        # `model` can be the path of the model file, which every worker process
+        # memory-maps instead of receiving a copy of the model
+        records = Parallel(n_jobs=n_jobs, return_as="generator")(
+            delayed(predict_cell)(
+                model, Fx, c, j, halo, bit_depth, crs, out_folder, verbose, uncertainty,
+                previous=entry, check=check,
+            )
+            for c, j, entry, check in jobs
+        )
+        for record in records:
+            if stats is not None:
+                stats.append(record)
             if pbar:
                 pbar.update(1)
-            i += 1
+    else:
+        Parallel(n_jobs=n_jobs, prefer="threads")(delayed(run)(*job) for job in jobs)
     return i
 
 
-def merge_folder(folder, output, crs="EPSG:3067"):
+def save_stats(stats, output):
+    """Saves the cell records from calculate as csv or, for other suffixes, JSON lines"""
+    output = Path(output)
+    with open(output, "w", newline="") as f:
+        if output.suffix == ".csv":
+            writer = csv.DictWriter(f, fieldnames=list(stats[0].keys()))
+            writer.writeheader()
+            writer.writerows(stats)
+        else:
+            f.writelines([json.dumps(record) + "\n" for record in stats])
+
+
+def print_stats(stats, elapsed):
+    """Prints the time spent in each stage and the throughput of a run"""
+    totals = {key: sum(r[key] for r in stats) for key in STAGES}
+    stage_total = sum(totals.values()) or 1
+    pixels = sum(r["pixels"] for r in stats)
+    bytes_read = sum(r["bytes_read"] for r in stats)
+    bytes_written = sum(r["bytes_written"] for r in stats)
+    statuses = {}
+    for r in stats:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+
+    print(f"\nProcessed {len(stats)} cells in {elapsed:.1f} s: {statuses}")
+    print("Stage\t\ttime (s)\tshare")
+    for key, total in totals.items():
+        print(f"{key[:-2]:<10}\t{total:.2f}\t\t{100 * total / stage_total:.1f} %")
+    print(
+        f"Throughput {pixels / elapsed:.0f} pixels/s, "
+        f"read {bytes_read / 1024**2 / elapsed:.2f} MB/s, "
+        f"written {bytes_written / 1024**2 / elapsed:.2f} MB/s"
+    )
+    print(f"Most time is spent in stage '{max(totals, key=totals.get)[:-2]}'")
+
+
+def probe_inference(model, Fx, size=256):
+    """
+    Runs the read, inference and quantization steps on a window in the middle of
+    the raster. Returns the peak memory in bytes and the time in seconds per pixel.
+    """
+    ny, nx = Fx.shape[1:]
+    y0 = max(0, ny // 2 - size // 2)
+    x0 = max(0, nx // 2 - size // 2)
+    window = Fx[:, y0 : y0 + size, x0 : x0 + size]
+
+    def run():
+        A = np.asarray(window.compute())
+        C = full_inference_numpy(A, model)
+        (C * (2**8 - 1)).astype("uint16")
+        return A.shape[1] * A.shape[2]
+
+    t0 = time.perf_counter()
+    n_pixels = run()
+    seconds = time.perf_counter() - t0
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak / n_pixels, seconds / n_pixels
+
+
+def auto_cell_size(model, Fx, input_raster, halo=0, memory_budget=None, n_jobs=None):
+    """
+    Chooses the cell size in meters and the number of parallel cells so that the
+    cells being processed fit to `memory_budget` (MB). By default half of the
+    available memory is used. Cell sides are multiples of the raster block size.
+    """
+    with rasterio.open(input_raster) as src:
+        block_y, block_x = src.block_shapes[0]
+        res = abs(src.res[0])
+        dtype = src.dtypes[0]
+    n_bands, ny, nx = Fx.shape
+    n_classes = len(model.classes_)
+
+    bytes_per_pixel, seconds_per_pixel = probe_inference(model, Fx)
+    # The probe does not include the copy made when slicing the halo away
+    bytes_per_pixel += n_classes * np.dtype("float64").itemsize
+
+    if memory_budget is None:
+        available = available_memory()
+        if available is None:
+            raise Exception("Could not measure available memory. Set --memory_budget")
+        budget = available / 2
+    else:
+        budget = memory_budget * 1024**2
+
+    block = max(block_y, block_x)
+    if n_jobs is None:
+        # Each worker should get cells of at least 4 blocks
+        n_jobs = int(np.clip(budget // (4 * block**2 * bytes_per_pixel), 1, os.cpu_count() or 1))
+
+    # Cells larger than the raster shared between the workers are not needed
+    pixels = min(budget / n_jobs / bytes_per_pixel, ny * nx / n_jobs)
+    side = int(np.sqrt(pixels) - 2 * halo)
+    side = max(block, side // block * block)
+    cell_size = int(side * res)
+
+    print(
+        f"Raster: {n_bands} bands of {dtype}, block size {block_y}x{block_x}, "
+        f"model with {n_classes} classes"
+        f"\nMemory budget {budget / 1024**2:.0f} MB, {bytes_per_pixel:.0f} bytes "
+        f"and {seconds_per_pixel * 1e6:.2f} µs per pixel"
+        f"\nUsing --cell_size {cell_size} ({side}x{side} pixels) with {n_jobs} workers"
+        f"\nEstimated inference time {seconds_per_pixel * ny * nx / n_jobs / 60:.1f} min"
+    )
+    return cell_size, n_jobs
+
+
+def set_vrt_descriptions(vrt, descriptions):
+    """
+    Sets the band descriptions of a vrt file by editing its XML, as gdalbuildvrt
+    does not copy them from the sources
+    """
+    tree = ET.parse(vrt)
+    bands = tree.getroot().findall("VRTRasterBand")
+    for band, description in zip(bands, descriptions):
+        element = band.find("Description")
+        if element is None:
+            element = ET.Element("Description")
+            band.insert(0, element)
+        element.text = str(description)
+    tree.write(vrt)
+
+
+def merge_folder(folder, output, crs="EPSG:3067", bands=None, descriptions=None):
+    """
+    Merges the cells in `folder` to the vrt file `output`. `bands` selects the
+    1-based bands of the cells included in the vrt, and `descriptions` are the
+    descriptions of the bands of the vrt.
+    """
     folder = Path(folder)
 
     filelist = list(folder.glob("*.tif"))
@@ -178,163 +772,219 @@ def merge_folder(folder, output, crs="EPSG:3067"):
             folder / "filelist.txt",
             "-a_srs",
             crs,
+            *[arg for b in bands or [] for arg in ("-b", str(b))],
             output,
         ]
     )
+    if descriptions is not None and Path(output).exists():
+        set_vrt_descriptions(output, descriptions)
+
+
+def infer_block(block, model, bit_depth=8, halo=0, uncertainty=None, block_info=None):
+    """
+    Quantized class confidences of a (band, y, x) block, followed by the
+    `uncertainty` measures. `halo` pixels are sliced off the sides of the block
+    that were extended from a neighbouring chunk; like the cells, chunks at the
+    edges of the raster are not extended. Empty blocks are zeros.
+    """
+    # Halo on the top, bottom, left and right. Without block_info, on all sides
+    top = bottom = left = right = halo
+    if halo and block_info is not None:
+        _, iy, ix = block_info[0]["chunk-location"]
+        _, ny, nx = block_info[0]["num-chunks"]
+        top, bottom = halo * (iy > 0), halo * (iy < ny - 1)
+        left, right = halo * (ix > 0), halo * (ix < nx - 1)
+    y0, y1 = top, block.shape[1] - bottom
+    x0, x1 = left, block.shape[2] - right
+
+    n_bands = len(model.classes_) + len(uncertainty or [])
+    if not block.any():
+        return np.zeros((n_bands, y1 - y0, x1 - x0), dtype="uint16")
+    if uncertainty:
+        C, U = full_inference_uncertainty(block, model, uncertainty)
+        C = np.concatenate([C, U])
+    else:
+        C = full_inference_numpy(block, model)
+    C = C[:, y0:y1, x0:x1]
+    return (C * (2**bit_depth - 1)).astype("uint16")
 
 
-def add_args(subparser):
-    parser = subparser.add_parser("predict")
-    parser.add_argument(
-        "--model", type=str, required=True, help="Location of pickled model"
-    )
+def start_client(scheduler="local", n_workers=None):
+    """
+    Connects to the dask scheduler at `scheduler`, or starts a LocalCluster
+    if `scheduler` is 'local'.
+    """
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        raise Exception("Distributed prediction requires dask.distributed: pip install distributed")
 
-    parser.add_argument(
-        "--input_raster",
-        type=str,
-        required=True,
-        help="The input raster to be classified",
-    )
+    if scheduler == "local":
+        return Client(LocalCluster(n_workers=n_workers))
+    return Client(scheduler)
 
-    parser.add_argument(
-        "--cell_size",
-        type=int,
-        required=True,
-        help="The raster is split up to smaller blocks of cell_size X "
-        "cell_size. Use as large value as your memory permits.",
-    )
 
-    parser.add_argument(
-        "--cell_buffer",
-        "--block_buffer",
-        type=int,
-        required=True,
-        help="Buffers each cell this much in meters",
+def predict_dask(
+    model, Fx, output, client, bit_depth=8, crs="EPSG:3067", halo=0, uncertainty=None
+):
+    """
+    Predicts the raster as a dask graph over its chunks on the cluster of `client`.
+    Chunks are read with `halo` pixels of context from their neighbours. The
+    `uncertainty` measures follow the class confidences as extra bands.
+    The model is sent once to every worker and the quantized confidences are written
+    to the GeoTIFF `output` with a distributed lock, so the workers can write to a
+    shared file system.
+    """
+    from dask.distributed import Lock
+
+    n_classes = len(model.classes_) + len(uncertainty or [])
+    model_future = client.scatter(model, broadcast=True)
+
+    data = Fx.data
+    if halo:
+        # Chunks at the edges of the raster are not extended, as in the cell mode
+        data = da.overlap.overlap(data, depth={0: 0, 1: halo, 2: halo}, boundary="none")
+    data = data.map_blocks(
+        infer_block,
+        model_future,
+        bit_depth=bit_depth,
+        halo=halo,
+        uncertainty=uncertainty,
+        dtype="uint16",
+        chunks=((n_classes,),) + Fx.data.chunks[1:],
     )
-
-    parser.add_argument(
-        "--bit_depth",
-        type=int,
-        required=False,
-        default=8,
-        help="Output confidence raster is quantized to this range. "
-        "If bit depth is 8, values range from 0-255.",
+    out_C = xr.DataArray(
+        data,
+        coords={"band": np.arange(1, n_classes + 1), "y": Fx.y, "x": Fx.x},
+        dims=("band", "y", "x"),
     )
-
-    parser.add_argument(
-        "--extent",
-        type=str,
-        required=False,
-        help="Providing an extent geometry makes processing faster as "
-        "areas outside extent are not calculated. If not provided, "
-        "calculation starts by finding empty cells.",
+    out_C = out_C.rio.write_crs(crs)
+    out_C.attrs["long_name"] = tuple(
+        str(label) for label in list(model.classes_) + (uncertainty or [])
     )
-    parser.add_argument(
-        "--calculate_empty",
-        action="store_true",
-        help="Passing this argument calculates all empty cells. "
-        "Useful ff extent is not provided and the raster is not rectangular",
+    out_C.rio.to_raster(
+        output,
+        compress="LZW",
+        tiled=True,
+        lock=Lock("point-eo-predict"),
     )
 
-    parser.add_argument("--out_folder", type=str, required=True, help="Output folder")
 
-    parser.add_argument(
-        "--start_index",
-        type=int,
-        required=False,
-        help="Starts processing from here in case of a crash.",
-    )
-    parser.add_argument(
-        "--crs", type=str, required=False, default="EPSG:3067", help="CRS for outputs"
-    )
+def prepare_raster(model, input_raster):
+    """Opens the raster with the bands used by the model, in the order of the model"""
+    band_names = model_bands(model)
+    if band_names is not None:
+        bands = band_indices(input_raster, band_names)
+        print(f"Reading bands {[b + 1 for b in bands]} used by the model")
+    else:
+        bands = None
+    Fx = open_raster(input_raster, bands=bands)
+
+    n_features = getattr(model, "n_features_in_", None)
+    if n_features is not None and n_features != Fx.shape[0]:
+        raise Exception(
+            f"The model expects {n_features} bands but {Fx.shape[0]} bands "
+            "are read from the raster"
+        )
+    return Fx
 
-    parser.add_argument(
-        "--verbose", type=int, default=1, help="Set to 2 if you want everything to be printed. Default 1"
-    )
 
+def predict_array(model, Fx):
+    """
+    Predicts a (band, y, x) DataArray in memory. Returns the class probabilities
+    as a (class, y, x) DataArray with the classes of the model as coordinates.
+    """
+    C = full_inference_numpy(np.asarray(Fx), model)
+    out = new_3d_xda(C, Fx).assign_coords({"class": model.classes_})
+    if Fx.rio.crs is not None:
+        out = out.rio.write_crs(Fx.rio.crs)
+    return out
 
-def main(args):
-    input_file = Path(args.input_raster)
-    model_file = Path(args.model)
-    out_folder = Path(args.out_folder) / f"{input_file.stem}_patches"
-    try:
-        out_folder.mkdir(exist_ok=False, parents=True)
-    except FileExistsError:
-        print(f"Output folder '{out_folder}' already exists. Change the folder name to prevent overwrigin. Exiting.")
-        exit(1)
-    out_final = Path(args.out_folder)
-
-    # Model
-    print(f"Using model {args.model}")
-    with open(args.model, "rb") as f:
-        model = pickle.load(f)
-
-    print(model)
 
-    # Raster
-    chunk_s = 2**10
-    Fx = rioxarray.open_rasterio(
-        args.input_raster,
-        chunks={"band": -1, "x": chunk_s, "y": chunk_s},
-        lock=False,
-        parallel=True,
-    )
+def make_cells(Fx, cell_size, crs="EPSG:3067"):
+    """The calculation grid as a GeoSeries of non-overlapping cells"""
+    grid_cells = create_cell_grid(Fx, cell_size)
+    return gpd.GeoSeries(grid_cells, crs=crs)
 
-    # if args.extent:
-    #     # Clip the raster to the maximum bounds of the extent file
-    #     extent = gpd.read_file(args.extent)
-    #     bounds_geometry = shapely.geometry.box(*extent.total_bounds)
-    #     Fx = Fx.rio.clip([bounds_geometry], from_disk=True)
 
-    grid_cells = create_cell_grid(Fx, args.cell_size)
-    cell = gpd.GeoDataFrame(grid_cells, columns=["geometry"], crs=args.crs)
-    cell = cell.buffer(args.cell_buffer, cap_style=3, join_style=2)
-    cell.to_file(out_final / "cell_grid.geojson")
+def predict_cells(
+    model,
+    Fx,
+    cell,
+    out_folder,
+    halo=0,
+    bit_depth=8,
+    extent=None,
+    calculate_empty=False,
+    start_index=None,
+    crs="EPSG:3067",
+    n_jobs=1,
+    verbose=1,
+    processes=False,
+    uncertainty=None,
+    previous=None,
+    changed_area=None,
+):
+    """
+    Predicts the cells from make_cells and saves them to `out_folder`. Cells not
+    intersecting the `extent` GeoDataFrame are skipped, as are empty cells if
+    `calculate_empty` is set. With `processes`, cells are processed in `n_jobs`
+    processes instead of threads and `model` can be the path of the model file.
+    The `uncertainty` measures are saved to the subfolder uncertainty.
+
+    `previous` are the cell records of a previous run from load_manifest. Cells
+    with an unchanged input reuse their previous outputs. If the `changed_area`
+    geometry is given, cells not intersecting it are reused without reading.
+
+    Returns the cell records of predict_cell.
+    """
+    out_folder = Path(out_folder)
+    out_folder.mkdir(parents=True, exist_ok=True)
 
     # Print cell size
-    Ax_first = Fx.rio.clip([cell[len(cell)//2]], from_disk=True) # Take a cell from the middle of array
+    (ys, xs), _ = cell_window(Fx, cell[len(cell)//2], halo) # Take a cell from the middle of array
+    Ax_first = Fx[:, ys, xs]
     print(f"Cell size in pixels is: {Ax_first.shape}" \
           f"\nCell size in MB is: {Ax_first.nbytes / (1024*1024):.4f}" \
            "\nAdjust cell_size if a larger array fits to memory")
 
     # set start index
-    if not args.start_index:
+    if not start_index:
         si = -1
     else:
-        si = args.start_index
+        si = start_index
 
     # If an extent shp is provided, it is used
-    if args.extent:
-        extent = gpd.read_file(args.extent)
+    if extent is not None:
         calc_cells = cell.geometry.apply(lambda x: extent.intersects(x).any()).values
         if calc_cells.sum() == 0:
             raise Exception("Zero cells to be calculated! Check the extent and its CRS.")
-    elif args.calculate_empty:
+    elif calculate_empty:
         # otherwise find empty cells in parallel if calculate_empty is assigned
         try:
             # If the empty cells have been calculated they are cached
             calc_cells = np.load(out_folder / "empty_index.npy")
             print("found existing cell index")
         except FileNotFoundError:
-            list_of_delayed_functions = []
-
             print("Checking empty cells...")
             calc_cells = Parallel(n_jobs=-1)(delayed(check_cell)(Fx, c) for c in tqdm(cell))
 
             calc_cells = [x for x in calc_cells]
             np.save(out_folder / "empty_index.npy", calc_cells)
     else:
-        calc_cells = np.full(len(grid_cells), True)
+        calc_cells = np.full(len(cell), True)
 
     # Actual calculation and saving of cells
     # Cell list is split into lists of 1000 to solve memory issues and file handles running out
     full_cell_list = cell.iloc[calc_cells]
 
-    if (args.verbose == 1) or (args.verbose == 2):
+    if (verbose == 1) or (verbose == 2):
         pbar = tqdm(total=len(full_cell_list))
     else:
         pbar = None
 
+    stats = []
+    t0 = time.perf_counter()
     global_index = 0
     for cell_list in np.array_split(full_cell_list, 1000):
         global_index = calculate(
@@ -343,20 +993,298 @@ def main(args):
             cell_list=cell_list,
             start_index=si,
             global_index=global_index,
-            clip_buffer=args.cell_buffer,
+            halo=halo,
+            bit_depth=bit_depth,
+            crs=crs,
+            out_folder=out_folder,
+            verbose=verbose,
+            pbar=pbar,
+            n_jobs=n_jobs,
+            stats=stats,
+            processes=processes,
+            uncertainty=uncertainty,
+            previous=previous,
+            changed_area=changed_area,
+        )
+    if pbar:
+        pbar.close()
+
+    if stats and verbose:
+        print_stats(stats, time.perf_counter() - t0)
+    return stats
+
+
+def predict_raster(model, Fx, out_folder, output, cell_size, crs="EPSG:3067", **kwargs):
+    """
+    Predicts the whole raster in cells of `cell_size` meters, saves the cells to
+    `out_folder` and merges them to the vrt file `output`. Keyword arguments are
+    passed to predict_cells. Returns the cell records.
+    """
+    cell = make_cells(Fx, cell_size, crs=crs)
+    stats = predict_cells(model, Fx, cell, out_folder, crs=crs, **kwargs)
+    merge_folder(out_folder, output, crs=crs)
+    return stats
+
+
+def file_checksum(path, chunk_size=2**20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_settings(model_files, Fx, cell_size, halo=0, bit_depth=8, crs="EPSG:3067", **options):
+    """Settings of a run that must be equal for its outputs to be reused"""
+    settings = {
+        "models": [file_checksum(f) for f in model_files],
+        "transform": list(Fx.rio.transform())[:6],
+        "cell_size": cell_size,
+        "halo": halo,
+        "bit_depth": bit_depth,
+        "crs": crs,
+        **options,
+    }
+    # As read back from JSON
+    return json.loads(json.dumps(settings))
+
+
+def save_manifest(output, input_raster, settings, stats):
+    """Saves the settings and the window, checksum, status and files of the cells of a run"""
+    manifest = {
+        "input_raster": str(Path(input_raster).resolve()),
+        "settings": settings,
+        "cells": [
+            {key: r[key] for key in ("cell", "status", "window", "checksum", "files")}
+            for r in stats
+        ],
+    }
+    with open(output, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def print_reuse(stats, previous):
+    """Prints how many cells with outputs in a previous run were reused or predicted again"""
+    matched = [r for r in stats if previous.get(tuple(r["window"]), {}).get("files")]
+    reused = sum(r["status"] == "reused" for r in matched)
+    missing = sum(r["previous_missing"] for r in matched)
+    print(
+        f"Reused {reused} of the {len(matched)} cells with outputs in the previous run, "
+        f"{len(matched) - reused} predicted again"
+    )
+    if missing:
+        print(
+            f"Warning: {missing} cells were predicted again because their files "
+            "in the previous run are missing"
+        )
+
+
+def load_manifest(manifest_file, settings):
+    """
+    Cell records of a previous run by pixel window. Raises an exception if the
+    previous run used different `settings`.
+    """
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    differ = [key for key in settings if manifest["settings"].get(key) != settings[key]]
+    if differ:
+        raise Exception(
+            f"The previous run {manifest_file} differs in {', '.join(differ)}. "
+            "Outputs can be reused only with the same models, raster grid and options"
+        )
+    return {tuple(r["window"]): r for r in manifest["cells"]}
+
+
+def save_band_names(labels, output):
+    """Saves the labels of the output bands, one per line"""
+    with open(output, "w") as f:
+        f.writelines([f"{label}\n" for label in labels])
+
+
+def load_models(model_files, weights=None, combine="mean", extra=None):
+    """
+    Loads the model, or an Ensemble of several models named by their file stems.
+    Returns the model and the name used in the output files.
+    """
+    model_files = [Path(f) for f in model_files]
+    models = [load_model(f) for f in model_files]
+    if len(models) == 1 and weights is None and extra is None:
+        return models[0], model_files[0].stem
+    names = [f.stem for f in model_files]
+    model = Ensemble(models, weights=weights, names=names, combine=combine, extra=extra)
+    return model, "ensemble"
+
+
+def main(args):
+    input_file = Path(args.input_raster)
+    out_folder = Path(args.out_folder) / f"{input_file.stem}_patches"
+    try:
+        out_folder.mkdir(exist_ok=False, parents=True)
+    except FileExistsError:
+        print(f"Output folder '{out_folder}' already exists. Change the folder name to prevent overwrigin. Exiting.")
+        exit(1)
+    out_final = Path(args.out_folder)
+
+    # Model
+    print(f"Using model {', '.join(args.model)}")
+    model, model_name = load_models(
+        args.model, weights=args.weights, combine=args.combine, extra=args.ensemble_band
+    )
+    print(model)
+    if args.uncertainty:
+        probability_bands(model)
+        if "variance" in args.uncertainty and not is_forest(model):
+            raise Exception("--uncertainty variance needs a random forest model")
+
+    # Raster. Only the bands used by the model are read
+    Fx = prepare_raster(model, args.input_raster)
+
+    halo = args.halo if args.halo is not None else model_halo(model)
+    if args.cell_buffer and args.halo is None:
+        print(
+            "--cell_buffer is not needed and is ignored: cells are read as exact "
+            f"pixel windows with a halo of {halo} pixels. Set --halo for models "
+            "that need spatial context."
+        )
+
+    if args.dask_scheduler:
+        # The whole raster is one dask graph, cells are not used
+        if args.previous:
+            raise Exception("--previous is not supported with --dask_scheduler")
+        if args.extent:
+            Fx = Fx.rio.clip_box(*gpd.read_file(args.extent).total_bounds)
+        client = start_client(args.dask_scheduler, args.n_jobs)
+        print(f"Predicting on dask cluster {client.dashboard_link}")
+        output = out_final / f"{input_file.stem}__{model_name}_C.tif"
+        predict_dask(
+            model,
+            Fx,
+            output,
+            client,
             bit_depth=args.bit_depth,
             crs=args.crs,
-            out_folder=out_folder,
-            verbose=args.verbose,
-            pbar=pbar
+            halo=halo,
+            uncertainty=args.uncertainty,
         )
+        client.close()
+        print(f"Saved prediction to {output}")
+        if isinstance(model, Ensemble) or args.uncertainty:
+            save_band_names(
+                list(model.classes_) + (args.uncertainty or []),
+                output.with_name(f"{output.stem}_bands.txt"),
+            )
+        return
+
+    if args.cell_size is None:
+        raise Exception("Set --cell_size or --dask_scheduler")
+    elif args.cell_size == "auto":
+        cell_size, n_jobs = auto_cell_size(
+            model,
+            Fx,
+            args.input_raster,
+            halo=halo,
+            memory_budget=args.memory_budget,
+            n_jobs=args.n_jobs,
+        )
+    else:
+        cell_size = args.cell_size
+        n_jobs = args.n_jobs or 1
 
-    # Merge to a vrt file
-    merge_folder(
+    cell = make_cells(Fx, cell_size, crs=args.crs)
+    cell.to_file(out_final / "cell_grid.geojson")
+
+    settings = run_settings(
+        args.model,
+        Fx,
+        cell_size,
+        halo=halo,
+        bit_depth=args.bit_depth,
+        crs=args.crs,
+        weights=args.weights,
+        combine=args.combine,
+        ensemble_band=args.ensemble_band,
+        uncertainty=args.uncertainty,
+    )
+    previous = None
+    changed_area = None
+    if args.previous:
+        previous = load_manifest(args.previous, settings)
+        print(f"Reusing unchanged cells of {args.previous}")
+    if args.changed_area:
+        if previous is None:
+            raise Exception("--changed_area needs --previous")
+        area = gpd.read_file(args.changed_area).to_crs(args.crs)
+        # Cells read the halo around them
+        res = abs(Fx.rio.resolution()[0])
+        changed_area = shapely.union_all(area.geometry.values).buffer(halo * res)
+
+    # Worker processes memory-map a single model from its file. scikit-learn copies
+    # the trees of a forest to each process, so forests are shared as node arrays
+    model_file = None
+    arrays_file = None
+    if args.processes and not isinstance(model, Ensemble):
+        model_file = args.model[0]
+        if is_forest(model) and not isinstance(model, ArrayForest):
+            arrays_file = model_file = out_folder / f"{model_name}_arrays.pkl"
+            save_model(ArrayForest(model), arrays_file)
+    stats = predict_cells(
+        model_file or model,
+        Fx,
+        cell,
         out_folder,
+        halo=halo,
+        bit_depth=args.bit_depth,
+        extent=gpd.read_file(args.extent) if args.extent else None,
+        calculate_empty=args.calculate_empty,
+        start_index=args.start_index,
         crs=args.crs,
-        output=out_final / f"{input_file.stem}__{model_file.stem}_C.vrt",
+        n_jobs=n_jobs,
+        verbose=args.verbose,
+        processes=args.processes,
+        uncertainty=args.uncertainty,
+        previous=previous,
+        changed_area=changed_area,
     )
+    if arrays_file is not None:
+        arrays_file.unlink()
+    if previous is not None:
+        print_reuse(stats, previous)
+    if stats and args.profile_log:
+        save_stats(stats, args.profile_log)
+        print(f"Saved cell statistics to {args.profile_log}")
+
+    manifest = out_final / f"{input_file.stem}__{model_name}_manifest.json"
+    save_manifest(manifest, args.input_raster, settings, stats)
+    print(f"Saved manifest to {manifest}")
+
+    # Merge to a vrt file
+    output = out_final / f"{input_file.stem}__{model_name}_C.vrt"
+    labels = [str(c) for c in model.classes_]
+    if isinstance(model, Ensemble):
+        save_band_names(labels, output.with_name(f"{output.stem}_bands.txt"))
+    if isinstance(model, Ensemble) and model.combine == "stack":
+        # A vrt for each model, and the extra band, selecting its bands of the cells
+        for name, bands in model.output_bands().items():
+            suffix = f"ensemble_{name}" if name == model.extra else f"{name}_C"
+            merge_folder(
+                out_folder,
+                crs=args.crs,
+                output=out_final / f"{input_file.stem}__{suffix}.vrt",
+                bands=bands,
+                descriptions=[labels[b - 1] for b in bands],
+            )
+    else:
+        merge_folder(out_folder, crs=args.crs, output=output, descriptions=labels)
+
+    if args.uncertainty:
+        output = out_final / f"{input_file.stem}__{model_name}_U.vrt"
+        save_band_names(args.uncertainty, output.with_name(f"{output.stem}_bands.txt"))
+        merge_folder(
+            out_folder / "uncertainty",
+            crs=args.crs,
+            output=output,
+            descriptions=args.uncertainty,
+        )
 
 
 if __name__ == "__main__":
@@ -1,86 +1,236 @@
+import hashlib
+import os
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import rasterio as rio
 from pathlib import Path
 from pprint import pprint
 
+from point_eo.arguments.sample_raster import add_args
+from point_eo.utils import stratified_sample
 
-def add_args(subparser):
-    parser = subparser.add_parser("sample_raster")
-    parser.add_argument("--input", type=str, required=True)
-    parser.add_argument("--input_raster", type=str, required=True)
-    parser.add_argument("--target", type=str, help="target column")
-    parser.add_argument(
-        "--rename_target", type=str, help="target column is renamed to this"
-    )
-    parser.add_argument(
-        "--band_names", type=str, default=None, help="file with band names as rows"
-    )
-    parser.add_argument(
-        "--dropna",
-        type=int,
-        default=None,
-        help="drops rows with all values as this value",
-    )
-    parser.add_argument("--out_prefix", type=str, default="")
-    parser.add_argument("--out_folder", type=str, default=".")
-    parser.add_argument("--shp", action="store_true")
 
+class FeatureCache:
+    """
+    Content-addressed on-disk cache of sampled raster values.
 
-def main(args):
-    # Read files
-    gdf = gpd.read_file(args.input)
-    src = rio.open(args.input_raster, windowed=True)
-    print(f"Sampling raster {args.input_raster} using points from {args.input}")
+    Entries are .npz files with point coordinates and their values, one for each
+    tile of `tile_size` x `tile_size` pixels with sampled points, stored in a
+    folder named by a hash of the raster path, size and modification time (or
+    file checksum). A lookup loads only the tiles of the requested points. The
+    least recently used entries are removed when the cache grows over
+    `max_size` MB. `hits` and `misses` count the points looked up.
+    """
+
+    def __init__(self, folder, max_size=1024, checksum=False, tile_size=1024):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size * 1024**2
+        self.checksum = checksum
+        self.tile_size = tile_size
+        self.hits = 0
+        self.misses = 0
+
+    def raster_key(self, input_raster):
+        path = Path(input_raster).resolve()
+        h = hashlib.sha256(str(path).encode())
+        if self.checksum:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    h.update(block)
+        else:
+            stat = path.stat()
+            h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return h.hexdigest()[:32]
+
+    def tiles(self, key, coords, res):
+        """
+        Entry files of the tiles of the points `coords` (n, 2) on a raster with
+        pixels of `res` map units, and the index of the tile of each point
+        """
+        tile = np.floor(coords / (self.tile_size * res)).astype(np.int64)
+        tiles, inverse = np.unique(tile, axis=0, return_inverse=True)
+        files = [self.folder / key / f"{tx}_{ty}.npz" for tx, ty in tiles]
+        return files, inverse.ravel()
+
+    def lookup(self, key, coords, n_bands, dtype, res=1.0):
+        """
+        Values of the points `coords` (n, 2) found in the cache. Returns the
+        values (n, n_bands) and a boolean mask of the points that were found.
+        """
+        values = np.zeros((len(coords), n_bands), dtype=dtype)
+        found = np.zeros(len(coords), dtype=bool)
+        files, inverse = self.tiles(key, coords, res)
+        for i, entry in enumerate(files):
+            if not entry.exists():
+                continue
+            with np.load(entry) as data:
+                cached_coords = data["coords"]
+                cached_values = data["values"]
+            os.utime(entry)  # mark as recently used
+
+            # Points are matched by their exact coordinates
+            rows = np.flatnonzero(inverse == i)
+            index = pd.Index(cached_coords[:, 0] + 1j * cached_coords[:, 1])
+            pos = index.get_indexer(coords[rows, 0] + 1j * coords[rows, 1])
+            values[rows[pos >= 0]] = cached_values[pos[pos >= 0]]
+            found[rows] = pos >= 0
+
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return values, found
+
+    def store(self, key, coords, values, res=1.0):
+        """Adds the points `coords` (n, 2) and their values to the entries of their tiles"""
+        if len(coords) == 0:
+            return
+        (self.folder / key).mkdir(exist_ok=True)
+        files, inverse = self.tiles(key, coords, res)
+        for i, entry in enumerate(files):
+            rows = inverse == i
+            new_coords, new_values = coords[rows], values[rows]
+            if entry.exists():
+                with np.load(entry) as data:
+                    new_coords = np.concatenate([data["coords"], new_coords])
+                    new_values = np.concatenate([data["values"], new_values])
+                unique = ~pd.Index(new_coords[:, 0] + 1j * new_coords[:, 1]).duplicated()
+                new_coords, new_values = new_coords[unique], new_values[unique]
+            np.savez(entry, coords=new_coords, values=new_values)
+        self.evict(keep=files)
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used entries, except `keep`, until the cache
+        fits to max_size
+        """
+        keep = {Path(p) for p in keep}
+        entries = [(p, p.stat()) for p in self.folder.glob("*/*.npz")]
+        total = sum(stat.st_size for _, stat in entries)
+        for path, stat in sorted(entries, key=lambda x: x[1].st_mtime):
+            if total <= self.max_size:
+                break
+            if path in keep:
+                continue
+            path.unlink()
+            total -= stat.st_size
+        if total > self.max_size:
+            print(
+                f"Warning: the sampled values ({total / 1024**2:.1f} MB) do not fit "
+                f"to the cache size of {self.max_size / 1024**2:.1f} MB. Increase --cache_size"
+            )
+
+
+def sample_points(
+    gdf, src, target, rename_target=None, band_names=None, dropna=False, cache=None
+):
+    """
+    Samples the raster `src` (a path or an open rasterio dataset) at the points of `gdf`.
+    With a FeatureCache, only the points not found in the cache are read from the raster.
+
+    Returns the GeoDataFrame with the sampled band values and a DataFrame with the
+    target as the first column followed by the bands, ready for training.
+    """
+    if not isinstance(src, rio.io.DatasetReader):
+        src = rio.open(src)
+    gdf = gdf.copy()
 
     # Sample points
-    coords = [(x, y) for x, y in zip(gdf.geometry.x, gdf.geometry.y)]
-    gdf["rvalue"] = [x for x in src.sample(coords)]
+    coords = np.column_stack([gdf.geometry.x, gdf.geometry.y])
+    if cache is not None:
+        key = cache.raster_key(src.name)
+        res = abs(src.res[0])
+        values, found = cache.lookup(key, coords, src.count, src.dtypes[0], res)
+        if not found.all():
+            values[~found] = np.array([x for x in src.sample(coords[~found])])
+            cache.store(key, coords[~found], values[~found], res)
+        print(f"Found {found.sum()} of {len(coords)} points in the cache")
+    else:
+        values = np.array([x for x in src.sample(coords)])
 
     # Fix dataframe
-    bands = [f"band{i}" for i in range(len(gdf["rvalue"][0]))]
+    bands = [f"band{i}" for i in range(values.shape[1])]
 
-    if args.band_names:
-        with open(args.band_names) as f:
-            lines = f.readlines()
-        bandnames = [l.strip() for l in lines]
-        print("Using bandnames:")
-        pprint(bandnames)
-        if len(bands) != len(bandnames):
+    if band_names:
+        if len(bands) != len(band_names):
             raise Exception(
-                f"Mismatch in band names in file ({len(bandnames)})"
+                f"Mismatch in band names in file ({len(band_names)})"
                 f" and number of bands ({len(bands)})"
             )
         else:
-            bands = bandnames
+            bands = list(band_names)
 
     # Handle situation where the target band has the same name as
     # one of the sample bands
-    if args.target in bands:
-        if not args.rename_target:
+    if target in bands:
+        if not rename_target:
             raise Exception(
                 "One of the band names is same as the target. Set --rename_target"
             )
-        target = args.rename_target
-        gdf = gdf.rename({args.target: target}, axis=1)
+        gdf = gdf.rename({target: rename_target}, axis=1)
         print(
-            f"Target column has same name as bands. Renamed target column to {target}"
+            f"Target column has same name as bands. Renamed target column to {rename_target}"
         )
-    elif args.rename_target:
-        target = args.rename_target
-        gdf = gdf.rename({args.target: target}, axis=1)
-    else:
-        target = args.target
+        target = rename_target
+    elif rename_target:
+        gdf = gdf.rename({target: rename_target}, axis=1)
+        target = rename_target
 
-    gdf[bands] = gdf["rvalue"].values.tolist()
-    gdf[bands] = gdf[bands].astype(src.meta["dtype"])
-    gdf = gdf.drop(["rvalue"], axis=1)
+    gdf[bands] = pd.DataFrame(values, index=gdf.index).astype(src.meta["dtype"])
 
     # Create df for csv
     df = gdf[[target] + bands]
 
-    if args.dropna:
+    if dropna:
         df = df.loc[~(df[bands] == 0).all(axis=1)]  # drop rows where all values zeros
     df = df.dropna().reset_index().drop(["index"], axis=1)
+    return gdf, df
+
+
+def main(args):
+    # Read files
+    gdf = gpd.read_file(args.input)
+    src = rio.open(args.input_raster, windowed=True)
+    print(f"Sampling raster {args.input_raster} using points from {args.input}")
+
+    if args.band_names:
+        with open(args.band_names) as f:
+            lines = f.readlines()
+        bandnames = [l.strip() for l in lines]
+        print("Using bandnames:")
+        pprint(bandnames)
+    else:
+        bandnames = None
+
+    # Class-balanced and spatially thinned subset of the points
+    sample_rows = None
+    if args.max_per_class or args.thin_distance:
+        rows = stratified_sample(
+            gdf[args.target].to_numpy(),
+            max_per_class=args.max_per_class,
+            coords=np.column_stack([gdf.geometry.x, gdf.geometry.y]),
+            thin_distance=args.thin_distance,
+            random_state=args.sample_seed,
+        )
+        gdf = gdf.iloc[rows]
+        sample_rows = gdf.index.to_numpy()
+        print(f"Sampling {len(gdf)} points:")
+        print(gdf[args.target].value_counts().to_string())
+
+    if args.cache_dir:
+        cache = FeatureCache(args.cache_dir, args.cache_size, args.cache_checksum)
+    else:
+        cache = None
+
+    gdf, df = sample_points(
+        gdf,
+        src,
+        args.target,
+        rename_target=args.rename_target,
+        band_names=bandnames,
+        dropna=args.dropna,
+        cache=cache,
+    )
 
     # Saving
     shp_stem = Path(args.input).stem
@@ -98,5 +248,7 @@ def main(args):
         suffix = ".geojson"
 
     gdf.to_file(out_folder / out_stem.with_suffix(suffix))
+    if sample_rows is not None:
+        np.savetxt(out_folder / f"{out_stem}_sample_rows.txt", sample_rows, fmt="%s")
     df.to_csv(out_folder / out_stem.with_suffix(".csv"), index=False)
     print(f"Saved outputs to {str(out_folder / out_stem.with_suffix('.csv'))}")
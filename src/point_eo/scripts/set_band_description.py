@@ -12,6 +12,8 @@ Example:
 import sys
 from osgeo import gdal
 
+from point_eo.arguments.set_band_description import add_args
+
 
 def set_band_descriptions(filepath, bands):
     """
@@ -25,12 +27,6 @@ def set_band_descriptions(filepath, bands):
     del ds
 
 
-def add_args(subparser):
-    parser = subparser.add_parser("set_band_description")
-    parser.add_argument("--input_raster", help="path to geotiff")
-    parser.add_argument("--label_map", help="path to file with class names")
-
-
 def main(args):
     with open(args.label_map, "r") as f:
         bands = f.readlines()
@@ -3,15 +3,23 @@ This script trains an autoML model on
 """
 
 import argparse
+import hashlib
+import json
+import math
 import os
 import pickle
 from datetime import datetime, timedelta
 import sys
+import time
 from pathlib import Path
 
 import tpot
 import numpy as np
 import pandas as pd
+import sklearn
+from deap import creator, tools
+from joblib import Memory, Parallel, delayed
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import (
     accuracy_score,
@@ -22,6 +30,16 @@ from sklearn.metrics import (
 )
 from sklearn.model_selection import StratifiedKFold
 
+import point_eo
+from point_eo.arguments.tpot_train import add_args
+from point_eo.utils import (
+    cap_classes,
+    feature_matrix,
+    read_training_csv,
+    save_model,
+    stratified_sample,
+)
+
 
 def evaluate_rf(clf, X_test, y_test):
     y_pred = clf.predict(X_test)
@@ -42,43 +60,405 @@ def print_results(y_true, y_pred):
     )
 
 
-def add_args(subparser):
-    parser = subparser.add_parser("tpot_train")
-    parser.add_argument(
-        "--input", type=str, required=True, help="csv for model training"
-    )
-
-    parser.add_argument("--out_folder", type=str, required=True, help="output folder")
-
-    parser.add_argument(
-        "--out_prefix", type=str, required=True, help="output file prefix"
-    )
-
-    parser.add_argument("--generations", type=int, required=True, help="generations")
-
-    parser.add_argument(
-        "--population_size", type=int, required=True, help="population size"
-    )
-
-    parser.add_argument(
-        "--scoring", type=str, required=False, default="accuracy", help="scoring"
+def pareto_eq(ind1, ind2):
+    """Individuals with equal scores are equal on the Pareto front, as in TPOT"""
+    return np.allclose(ind1.fitness.values, ind2.fitness.values)
+
+
+def data_checksum(X, y):
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (X, y):
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.dtype}{arr.shape}".encode())
+        h.update(arr.data if arr.dtype != object else str(arr.tolist()).encode())
+    return h.hexdigest()
+
+
+def check_tpot_version():
+    """CheckpointTPOTClassifier uses private attributes of TPOT 0.12"""
+    if not tpot.__version__.startswith("0.12."):
+        raise Exception(
+            f"tpot_train needs TPOT 0.12, found {tpot.__version__}. "
+            'Install it with pip install "tpot>=0.12.2,<0.13"'
+        )
+
+
+class CheckpointTPOTClassifier(tpot.TPOTClassifier):
+    """
+    TPOTClassifier that saves its search state to `checkpoint_file` after every
+    generation and exports the best pipeline so far to `checkpoint_export`.
+    The state is the population, the Pareto front and the scores of all
+    evaluated pipelines, and load_checkpoint continues the search from it.
+    Pipelines of a restored population are not evaluated again. The random
+    state is not saved, so a resumed search differs from an uninterrupted one.
+
+    The search state is kept in private attributes of TPOT 0.12 (_pop,
+    _pareto_front, _pset, _fit_init and _check_periodic_pipeline), so other
+    versions are rejected by check_tpot_version.
+    """
+
+    checkpoint_file = None
+    checkpoint_export = None
+    checkpoint_data = None
+    generations_done = 0
+
+    def _check_periodic_pipeline(self, gen):
+        try:
+            super()._check_periodic_pipeline(gen)
+        finally:
+            self.generations_done += 1
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        if self.checkpoint_file is None or self._pareto_front is None:
+            return
+        state = {
+            "data": self.checkpoint_data,
+            "generations_done": self.generations_done,
+            "population": [str(ind) for ind in self._pop],
+            "pareto_front": [str(ind) for ind in self._pareto_front.items],
+            "evaluated_individuals": self.evaluated_individuals_,
+        }
+        # Written to a temporary file first, so that an interrupted write does
+        # not destroy the previous checkpoint
+        tmp = Path(f"{self.checkpoint_file}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint_file)
+
+        if self.checkpoint_export is not None and self._optimized_pipeline is not None:
+            tmp = Path(f"{self.checkpoint_export}.tmp")
+            with open(tmp, "w") as f:
+                f.write(self.export(""))
+            os.replace(tmp, self.checkpoint_export)
+
+    def seed_population(self, pipelines):
+        """Starts the search from the given pipeline strings. Call before fit."""
+        self.warm_start = True
+        self._fit_init()
+        self._pop = [creator.Individual.from_string(p, self._pset) for p in pipelines]
+
+    def top_pipelines(self, n):
+        """The `n` evaluated pipelines with the highest internal CV scores"""
+        scored = [
+            (stats["internal_cv_score"], pipeline)
+            for pipeline, stats in self.evaluated_individuals_.items()
+            if np.isfinite(stats["internal_cv_score"])
+        ]
+        return [pipeline for _, pipeline in sorted(scored, reverse=True)[:n]]
+
+    def load_checkpoint(self, checkpoint_file):
+        """Restores the search state saved by save_checkpoint. Call before fit."""
+        with open(checkpoint_file) as f:
+            state = json.load(f)
+        if self.checkpoint_data is not None and state["data"] != self.checkpoint_data:
+            raise Exception(
+                f"The checkpoint {checkpoint_file} was saved with different training data"
+            )
+
+        # Sets up the operators and the DEAP toolbox the individuals are parsed with
+        self.warm_start = True
+        self._fit_init()
+
+        evaluated = state["evaluated_individuals"]
+        for stats in evaluated.values():
+            stats["predecessor"] = tuple(stats["predecessor"])
+        self.evaluated_individuals_ = evaluated
+
+        def individual(pipeline):
+            ind = creator.Individual.from_string(pipeline, self._pset)
+            stats = evaluated[pipeline]
+            ind.fitness.values = (stats["operator_count"], stats["internal_cv_score"])
+            return ind
+
+        self._pop = [individual(pipeline) for pipeline in state["population"]]
+        self._pareto_front = tools.ParetoFront(similar=pareto_eq)
+        self._pareto_front.update([individual(pipeline) for pipeline in state["pareto_front"]])
+        self.generations_done = state["generations_done"]
+
+
+def search_tpot(
+    X,
+    y,
+    generations,
+    population_size,
+    scoring="accuracy",
+    random_state=42,
+    max_time=None,
+    checkpoint_file=None,
+    checkpoint_export=None,
+    resume=False,
+    population=None,
+    n_jobs=-1,
+):
+    """
+    Runs the TPOT search for `generations` generations or `max_time` minutes.
+    With `checkpoint_file`, the state of the search is saved after every
+    generation and the best pipeline so far is exported to `checkpoint_export`.
+    With `resume`, the search continues from an existing checkpoint for the
+    remaining generations. A new search starts from the `population` pipeline
+    strings if given. Pipelines are evaluated in `n_jobs` processes. Returns the
+    fitted TPOTClassifier.
+    """
+    check_tpot_version()
+    tpotC = CheckpointTPOTClassifier(
+        generations=generations,
+        population_size=population_size,
+        verbosity=2,
+        scoring=scoring,
+        random_state=random_state,
+        cv=5,
+        n_jobs=n_jobs,
+        max_time_mins=max_time,
+        # The population is kept after the search for the final checkpoint
+        warm_start=True,
     )
+    tpotC.checkpoint_file = checkpoint_file
+    tpotC.checkpoint_export = checkpoint_export
+    tpotC.checkpoint_data = data_checksum(X, y)
+
+    if resume and checkpoint_file is not None and Path(checkpoint_file).exists():
+        tpotC.load_checkpoint(checkpoint_file)
+        tpotC.generations = max(generations - tpotC.generations_done, 0)
+        print(
+            f"Resuming from {checkpoint_file} after {tpotC.generations_done} generations, "
+            f"{len(tpotC.evaluated_individuals_)} evaluated pipelines. "
+            f"{tpotC.generations} generations left"
+        )
+    else:
+        if resume:
+            print(f"No checkpoint {checkpoint_file} found, starting a new search")
+        if population is not None:
+            tpotC.seed_population(population)
+
+    tpotC.fit(X, y)
+    # Includes the pipelines evaluated in an interrupted generation
+    tpotC.save_checkpoint()
+    return tpotC
+
+
+def successive_halving(
+    X,
+    y,
+    generations,
+    population_size,
+    scoring="accuracy",
+    random_state=42,
+    min_fraction=0.1,
+    eta=3,
+    max_time=None,
+    checkpoint_prefix=None,
+    resume=False,
+    n_jobs=-1,
+):
+    """
+    Multi-fidelity TPOT search. The search runs in rungs on nested stratified
+    subsamples of the rows growing by `eta` from at least `min_fraction`. The
+    `generations` are shared between the rungs on subsamples. After each rung,
+    the best 1/eta of the population size of pipelines evaluated in it are
+    promoted to the next rung, and the last rung only scores the promoted
+    pipelines with 5-fold CV on all rows and fits the best one.
+
+    Returns the TPOTClassifier of the last rung and the log of the rungs.
+    """
+    # eta**-n_rungs, ..., 1/eta, 1 with the smallest at least min_fraction
+    n_rungs = int(np.floor(np.log(1 / min_fraction) / np.log(eta) + 1e-9))
+    fractions = [float(eta) ** -(n_rungs - r) for r in range(n_rungs + 1)]
+    n_search = max(len(fractions) - 1, 1)
+
+    deadline = time.time() + max_time * 60 if max_time else None
+    population = None
+    log = []
+    for rung, fraction in enumerate(fractions):
+        last = rung == len(fractions) - 1
+        rows = stratified_sample(y, fraction, min_per_class=5, random_state=random_state)
+        n_population = max(2, math.ceil(population_size / eta**rung))
+        if last and len(fractions) > 1:
+            rung_generations = 0
+        else:
+            rung_generations = generations // n_search + (rung < generations % n_search)
+        rung_time = None
+        if deadline is not None and not last:
+            rung_time = max((deadline - time.time()) / 60 / (n_search - rung), 0.1)
+
+        print(
+            f"\nRung {rung}: {len(rows)} rows ({100 * fraction:.0f} %), "
+            f"population {n_population}, {rung_generations} generations"
+        )
+        t0 = time.perf_counter()
+        tpotC = search_tpot(
+            X[rows],
+            y[rows],
+            generations=rung_generations,
+            population_size=n_population,
+            scoring=scoring,
+            random_state=random_state,
+            max_time=rung_time,
+            checkpoint_file=(
+                f"{checkpoint_prefix}_rung{rung}.json" if checkpoint_prefix else None
+            ),
+            checkpoint_export=f"{checkpoint_prefix}.py" if checkpoint_prefix else None,
+            resume=resume,
+            population=population,
+            n_jobs=n_jobs,
+        )
+        log.append(
+            {
+                "rung": rung,
+                "fraction": fraction,
+                "rows": len(rows),
+                "population": n_population,
+                "generations": rung_generations,
+                "evaluated": len(tpotC.evaluated_individuals_),
+                "best_score": tpotC._optimized_pipeline_score,
+                "minutes": (time.perf_counter() - t0) / 60,
+            }
+        )
+        population = tpotC.top_pipelines(max(2, math.ceil(population_size / eta ** (rung + 1))))
+    return tpotC, pd.DataFrame(log)
+
+
+def fit_predict(model, X, y, train, test):
+    """Fits a clone of `model` on the `train` rows and predicts the `test` rows"""
+    model = clone(model)
+    model.fit(X[train], y[train])
+    return model.predict(X[test])
+
+
+def compare_with_rf(
+    clf,
+    X,
+    y,
+    n_splits=5,
+    random_state=42,
+    n_jobs=1,
+    baseline="rf",
+    cache_dir=None,
+):
+    """
+    Cross-validates the pipeline `clf` against a default random forest.
+    The models of the folds are fitted in parallel in `n_jobs` processes.
+
+    `baseline` is "rf" to cross-validate a default random forest, None to skip
+    the baseline, or the cross-validated predictions of an earlier run for each
+    row of `X`, e.g. from analysis. With `cache_dir`, the predictions of each
+    fold are cached there by the model, the data and the fold, and are not
+    computed again on a rerun. The cache is never pruned.
+
+    Returns the true labels and the predictions of the baseline (None if
+    skipped) and of `clf`, in the order of the folds.
+    """
+    if sys.platform == "win32":
+        BOLD = RESET = ""
+    else:
+        BOLD = "\x1B[1m"
+        RESET = "\x1b[0m"
 
-    parser.add_argument(
-        "--sep", type=str, required=False, default=",", help="csv separator"
+    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    folds = list(skf.split(X, y))
+
+    predict_fold = fit_predict
+    if cache_dir is not None:
+        predict_fold = Memory(cache_dir, verbose=0).cache(fit_predict)
+
+    models = [clf]
+    if isinstance(baseline, str) and baseline == "rf":
+        models.append(RandomForestClassifier())
+    elif baseline is not None and len(baseline) != len(y):
+        raise Exception(
+            f"The baseline has {len(baseline)} predictions, the data has {len(y)} rows"
+        )
+
+    preds = Parallel(n_jobs=n_jobs)(
+        delayed(predict_fold)(model, X, y, train, test)
+        for train, test in folds
+        for model in models
     )
 
-    parser.add_argument(
-        "--decimal", type=str, required=False, default=".", help="decimal separator"
-    )
+    y_true = []
+    y_pred_rf = []
+    y_pred_automl = []
+    for i, (train, test) in enumerate(folds):
+        y_test = y[test]
+        y_pred_fold_automl = preds[i * len(models)]
+        if baseline is None:
+            y_pred_fold_rf = None
+        elif len(models) > 1:
+            y_pred_fold_rf = preds[i * len(models) + 1]
+        else:
+            y_pred_fold_rf = np.asarray(baseline)[test]
 
-    parser.add_argument(
-        "--remove_classes_smaller_than",
-        type=int,
-        required=False,
-        default=None,
-        help="Classes smaller than this value are removed. Default None",
-    )
+        print(BOLD + f"\nFold {i}:" + RESET)
+        if y_pred_fold_rf is not None:
+            print("\nRF:")
+            print_results(y_test, y_pred_fold_rf)
+            y_pred_rf.append(y_pred_fold_rf)
+        print("\nTPOT AutoML:")
+        print_results(y_test, y_pred_fold_automl)
+
+        y_true.append(y_test)
+        y_pred_automl.append(y_pred_fold_automl)
+
+    y_true = np.concatenate(y_true)
+    y_pred_rf = np.concatenate(y_pred_rf) if baseline is not None else None
+    y_pred_automl = np.concatenate(y_pred_automl)
+    return y_true, y_pred_rf, y_pred_automl
+
+
+def load_baseline(predictions_file, rows, y):
+    """
+    Reads the cross-validated predictions saved by analysis and orders them as
+    the rows of the input csv in `rows`. The predictions must cover all rows
+    with the same labels, i.e. come from an analysis run on the same input.
+    """
+    df = pd.read_csv(predictions_file)
+    if "row" not in df.columns:
+        raise Exception(
+            f"{predictions_file} has no row column. Rerun analysis to save the "
+            "rows of the predictions"
+        )
+    df = df.set_index("row")
+    missing = np.setdiff1d(rows, df.index)
+    if len(missing):
+        raise Exception(
+            f"{predictions_file} has no predictions for {len(missing)} rows of the "
+            "input. Run analysis on the same input with the same removed classes"
+        )
+    df = df.loc[rows]
+    if not np.array_equal(df["y_true"].to_numpy().astype(str), np.asarray(y).astype(str)):
+        raise Exception(f"The labels of {predictions_file} differ from the input")
+    return df["y_pred"].to_numpy()
+
+
+def fit_final(clf, X, y, feature_names=None):
+    """
+    Fits a clone of the pipeline on all rows. The band names let predict read
+    only the used bands, as with the models of analysis.
+    """
+    model = clone(clf).fit(X, y)
+    if feature_names is not None:
+        model.band_names_ = [str(x) for x in feature_names]
+    return model
+
+
+def model_metadata(tpotC, model, y_true, y_pred, **extra):
+    """Training metadata saved next to the model"""
+    return {
+        "pipeline": str(tpotC._optimized_pipeline),
+        "internal_cv_score": float(tpotC._optimized_pipeline_score),
+        "cv_accuracy": float(accuracy_score(y_true, y_pred)),
+        "cv_f1_weighted": float(
+            f1_score(y_true, y_pred, zero_division=0, average="weighted")
+        ),
+        "classes": [str(x) for x in model.classes_],
+        "bands": getattr(model, "band_names_", None),
+        **extra,
+        "versions": {
+            "point_eo": point_eo.__version__,
+            "tpot": tpot.__version__,
+            "scikit-learn": sklearn.__version__,
+        },
+    }
 
 
 def main(args):
@@ -95,7 +475,7 @@ def main(args):
     out_folder.mkdir(parents=True, exist_ok=True)
 
     # Read csv
-    df = pd.read_csv(args.input, sep=args.sep, decimal=args.decimal)
+    df = read_training_csv(args.input, sep=args.sep, decimal=args.decimal)
 
     dfY = df.iloc[:, 0]
     dfX = df.iloc[:, 1:]
@@ -123,8 +503,15 @@ def main(args):
     print(drop_classes)
     print()
 
+    if args.max_per_class:
+        rows_file = out_folder / f"{args.out_prefix}_sample_rows_{uid}.txt"
+        dfX, dfY = cap_classes(dfX, dfY, args.max_per_class, args.sample_seed, rows_file)
+        print(f"Sampled at most {args.max_per_class} rows per class, {len(dfY)} rows")
+        print(f"Saved the sampled rows to {rows_file}")
+        print()
+
     # Final dataset
-    X = dfX.to_numpy()
+    X = feature_matrix(dfX)
     y = dfY.to_numpy()
 
     print(f"Shape of X: {X.shape}")
@@ -143,64 +530,104 @@ def main(args):
 
     print("Processing...")
 
-    tpotC = tpot.TPOTClassifier(
-        generations=args.generations,
-        population_size=args.population_size,
-        verbosity=2,
-        scoring=args.scoring,
-        random_state=seed,
-        cv=5,
-        n_jobs=-1,
-    )
-
-    tpotC.fit(X_train, y_train)
+    if args.successive_halving:
+        tpotC, log = successive_halving(
+            X_train,
+            y_train,
+            generations=args.generations,
+            population_size=args.population_size,
+            scoring=args.scoring,
+            random_state=seed,
+            min_fraction=args.min_fraction,
+            eta=args.eta,
+            max_time=args.max_time,
+            checkpoint_prefix=out_folder / f"{args.out_prefix}_checkpoint",
+            resume=args.resume,
+            n_jobs=args.n_jobs,
+        )
+        print(BOLD + "\nSuccessive halving budgets:" + RESET)
+        print(log.to_string(index=False))
+        log.to_csv(out_folder / f"{args.out_prefix}_halving_{uid}.csv", index=False)
+    else:
+        tpotC = search_tpot(
+            X_train,
+            y_train,
+            generations=args.generations,
+            population_size=args.population_size,
+            scoring=args.scoring,
+            random_state=seed,
+            max_time=args.max_time,
+            checkpoint_file=out_folder / f"{args.out_prefix}_checkpoint.json",
+            checkpoint_export=out_folder / f"{args.out_prefix}_checkpoint.py",
+            resume=args.resume,
+            n_jobs=args.n_jobs,
+        )
     clf = tpotC.fitted_pipeline_
     print("Done")
 
     print("\n RUN STATISTICS:")
     print(tpotC.score(X_test, y_test))
 
-    y_true = []
-    y_pred_rf = []
-    y_pred_automl = []
-
-    for i, (train, test) in enumerate(skf.split(X, y)):
-        X_train = X[train, :]
-        X_test = X[test, :]
-        y_train = y[train]
-        y_test = y[test]
-
-        print(BOLD + f"\nFold {i}:" + RESET)
-        rf = RandomForestClassifier()
-
-        rf.fit(X_train, y_train)
-        clf.fit(X_train, y_train)
-
-        print("\nRF:")
-        acc, prec, f1 = evaluate_rf(rf, X_test, y_test)
-        print("\nTPOT AutoML:")
-        acc, prec, f1 = evaluate_rf(clf, X_test, y_test)
-
-        y_pred_fold_rf = rf.predict(X_test)
-        y_pred_fold_automl = clf.predict(X_test)
+    if args.no_baseline:
+        baseline = None
+    elif args.baseline_predictions:
+        baseline = load_baseline(args.baseline_predictions, dfX.index.to_numpy(), y)
+        print(f"Using the baseline predictions of {args.baseline_predictions}")
+    else:
+        baseline = "rf"
 
-        y_true = np.concatenate((y_true, y_test))
-        y_pred_rf = np.concatenate((y_pred_rf, y_pred_fold_rf))
-        y_pred_automl = np.concatenate((y_pred_automl, y_pred_fold_automl))
+    y_true, y_pred_rf, y_pred_automl = compare_with_rf(
+        clf,
+        X,
+        y,
+        random_state=seed,
+        n_jobs=args.n_jobs,
+        baseline=baseline,
+        cache_dir=args.cache_dir,
+    )
 
     print(BOLD + "\n\nFINAL RESULTS:" + RESET)
-    print("\nRF results:")
-    print_results(y_true, y_pred_rf)
+    if y_pred_rf is not None:
+        print("\nRF results:")
+        print_results(y_true, y_pred_rf)
 
     print("\nTPOT AutoML results:")
     print_results(y_true, y_pred_automl)
 
     acc = accuracy_score(y_true, y_pred_automl)
+    out_stem = f"{args.out_prefix}_acc{acc:.4f}_{uid}"
 
-    # Save the model
-    output_name = out_folder / f"{args.out_prefix}_acc{acc:.4f}_{uid}.py"
+    # Save the pipeline fitted on all rows, ready for predict
+    model = fit_final(clf, X, y, dfX.columns)
+    output_name = out_folder / f"{out_stem}_model.pkl"
     print(f"\nSaving model to {output_name}")
-    tpotC.export(output_name)
+    save_model(model, output_name)
+
+    metadata = model_metadata(
+        tpotC,
+        model,
+        y_true,
+        y_pred_automl,
+        input=str(args.input),
+        rows=len(y),
+        scoring=args.scoring,
+        generations=args.generations,
+        population_size=args.population_size,
+        successive_halving=args.successive_halving,
+        random_state=seed,
+        uid=uid,
+    )
+    with open(out_folder / f"{out_stem}_model.json", "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    with open(out_folder / f"{out_stem}_label_map.txt", "w") as f:
+        f.writelines([str(x) + "\n" for x in model.classes_])
+
+    # The exported script documents the pipeline
+    if not args.no_export:
+        output_name = out_folder / f"{out_stem}.py"
+        print(f"Exporting pipeline to {output_name}")
+        tpotC.export(output_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+"""
+Aggregates predictions to polygons: class histograms, majority class, mean class
+confidences and mean confidence of each polygon
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.windows import bounds as window_bounds
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from point_eo.arguments.zonal_stats import add_args
+from point_eo.utils import block_windows
+
+
+def zone_block(
+    input_raster,
+    window,
+    geometries,
+    confidence_raster=None,
+    all_touched=False,
+    nodata=None,
+):
+    """
+    Zonal sums of one block of the raster. The `geometries` intersecting the block
+    are rasterized with the zones 1, 2, ... in their order; overlapping polygons
+    get the pixels of the later polygon.
+
+    Pixels equal to the nodata value of a class raster, pixels where all
+    confidences of a confidence stack are zero and pixels where the confidence
+    is zero are skipped. `nodata` is skipped in a class raster that has no
+    nodata value.
+
+    Returns the class counts (polygon, class), the sums of the bands of a
+    confidence stack (polygon, band) or None, and the sums of the confidence
+    raster (polygon,) or None.
+    """
+    with rasterio.open(input_raster) as src:
+        A = src.read(window=window)
+        transform = src.window_transform(window)
+        if src.nodata is not None:
+            nodata = src.nodata
+
+    zones = rasterize(
+        zip(geometries, range(1, len(geometries) + 1)),
+        out_shape=(window.height, window.width),
+        transform=transform,
+        fill=0,
+        all_touched=all_touched,
+        dtype="int32",
+    )
+    valid = zones > 0
+
+    if A.shape[0] == 1:
+        classes = A[0]
+        if nodata is not None:
+            valid &= classes != nodata
+    else:
+        classes = A.argmax(axis=0)
+        valid &= A.any(axis=0)
+
+    M = None
+    if confidence_raster is not None:
+        with rasterio.open(confidence_raster) as src:
+            M = src.read(1, window=window)
+        valid &= M != 0
+
+    n = len(geometries) + 1
+    z = zones[valid].astype("int64")
+    c = classes[valid].astype("int64")
+    n_classes = A.shape[0] if A.shape[0] > 1 else int(c.max(initial=0)) + 1
+
+    # Counts of each (zone, class) pair in one pass
+    counts = np.bincount(z * n_classes + c, minlength=n * n_classes)
+    counts = counts.reshape(n, n_classes)[1:]
+
+    sums = None
+    if A.shape[0] > 1:
+        sums = np.stack(
+            [np.bincount(z, weights=band[valid], minlength=n)[1:] for band in A], axis=1
+        )
+    conf = None
+    if M is not None:
+        conf = np.bincount(z, weights=M[valid], minlength=n)[1:]
+    return counts, sums, conf
+
+
+def zonal_stats(
+    input_raster,
+    polygons,
+    confidence_raster=None,
+    block_size=1024,
+    all_touched=False,
+    bit_depth=8,
+    n_jobs=1,
+    verbose=1,
+    nodata=None,
+):
+    """
+    Zonal statistics of a classification raster (S) or a confidence stack over
+    the polygons of a GeoDataFrame. The raster is processed in blocks of
+    `block_size` pixels in `n_jobs` threads, and only blocks intersecting
+    polygons are read. Integer confidences are scaled by 2**bit_depth - 1.
+
+    Pixels without a prediction are skipped: the nodata value of a class raster,
+    pixels where all confidences are zero and pixels where the confidence raster
+    is zero. A class raster without a nodata value, like the S of
+    postprocess_prediction, cannot tell empty pixels from class 0, so it needs
+    either a `confidence_raster` or the `nodata` value to skip (a value outside
+    the classes, e.g. -1, counts all pixels).
+
+    Returns a DataFrame with the index of `polygons` and the columns pixels,
+    majority (class index), count_{class}, mean_{class} for confidence stacks
+    and mean_confidence for the `confidence_raster` (M).
+    """
+    with rasterio.open(input_raster) as src:
+        height, width = src.shape
+        transform = src.transform
+        crs = src.crs
+        n_bands = src.count
+        integer = np.issubdtype(np.dtype(src.dtypes[0]), np.integer)
+        has_nodata = src.nodata is not None
+
+    if n_bands == 1 and not has_nodata and confidence_raster is None and nodata is None:
+        raise Exception(
+            f"{input_raster} has no nodata value, so its empty pixels cannot be told "
+            "from class 0. Give --confidence_raster or --nodata (-1 counts all pixels)"
+        )
+
+    if confidence_raster is not None:
+        with rasterio.open(confidence_raster) as src:
+            if src.shape != (height, width) or src.transform != transform:
+                raise Exception(
+                    f"{confidence_raster} is not on the same grid as {input_raster}"
+                )
+
+    if crs is not None and polygons.crs is not None and polygons.crs != crs:
+        polygons = polygons.to_crs(crs)
+    geometries = polygons.geometry.values
+    sindex = polygons.sindex
+
+    # Blocks without polygons are not read
+    jobs = []
+    for window in block_windows(height, width, block_size):
+        box = shapely.box(*window_bounds(window, transform))
+        idx = np.sort(sindex.query(box, predicate="intersects"))
+        if len(idx):
+            jobs.append((idx, window))
+
+    n = len(polygons)
+    counts = np.zeros((n, n_bands if n_bands > 1 else 1), dtype="int64")
+    sums = np.zeros((n, n_bands)) if n_bands > 1 else None
+    conf = np.zeros(n) if confidence_raster is not None else None
+
+    def run(idx, window):
+        return idx, zone_block(
+            input_raster, window, geometries[idx], confidence_raster, all_touched, nodata
+        )
+
+    results = Parallel(n_jobs=n_jobs, prefer="threads", return_as="generator_unordered")(
+        delayed(run)(idx, window) for idx, window in jobs
+    )
+    for idx, (block_counts, block_sums, block_conf) in tqdm(
+        results, total=len(jobs), disable=not verbose
+    ):
+        # Classes of a class raster are found block by block
+        if block_counts.shape[1] > counts.shape[1]:
+            counts = np.pad(counts, ((0, 0), (0, block_counts.shape[1] - counts.shape[1])))
+        counts[idx, : block_counts.shape[1]] += block_counts
+        if block_sums is not None:
+            sums[idx] += block_sums
+        if block_conf is not None:
+            conf[idx] += block_conf
+
+    pixels = counts.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 2**bit_depth - 1 if integer else 1
+        out = {"pixels": pixels}
+        out["majority"] = np.where(pixels > 0, counts.argmax(axis=1), -1)
+        for k in range(counts.shape[1]):
+            out[f"count_{k}"] = counts[:, k]
+        if sums is not None:
+            for k in range(sums.shape[1]):
+                out[f"mean_{k}"] = sums[:, k] / pixels / scale
+        if conf is not None:
+            out["mean_confidence"] = conf / pixels / scale
+    return pd.DataFrame(out, index=polygons.index)
+
+
+def main(args):
+    polygons = gpd.read_file(args.polygons)
+    if polygons.crs is None:
+        polygons = polygons.set_crs(args.crs)
+    print(f"Read {len(polygons)} polygons from {args.polygons}")
+
+    stats = zonal_stats(
+        args.input_raster,
+        polygons,
+        confidence_raster=args.confidence_raster,
+        block_size=args.block_size,
+        all_touched=args.all_touched,
+        bit_depth=args.bit_depth,
+        n_jobs=args.n_jobs,
+        nodata=args.nodata,
+    )
+
+    if args.label_map:
+        with open(args.label_map) as f:
+            labels = [label.strip() for label in f if label.strip()]
+        n_classes = sum(col.startswith("count_") for col in stats.columns)
+        if len(labels) < n_classes:
+            raise Exception(
+                f"{args.label_map} has {len(labels)} classes, the raster has {n_classes}"
+            )
+        rename = {}
+        for k, label in enumerate(labels):
+            rename[f"count_{k}"] = f"count_{label}"
+            rename[f"mean_{k}"] = f"mean_{label}"
+        stats = stats.rename(columns=rename)
+        stats["majority"] = [labels[k] if k >= 0 else None for k in stats["majority"]]
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if output.suffix == ".csv":
+        if args.id_column:
+            stats.insert(0, args.id_column, polygons[args.id_column].values)
+        stats.to_csv(output, index=args.id_column is None)
+    else:
+        clashing = polygons.columns.intersection(stats.columns)
+        if len(clashing):
+            print(
+                f"The polygons already have the columns {', '.join(clashing)}, "
+                "the statistics are saved with the suffix _zonal"
+            )
+        polygons.join(stats, rsuffix="_zonal").to_file(output)
+    print(f"Saved zonal statistics of {len(stats)} polygons to {output}")
+
+
+if __name__ == "__main__":
+    main()
+    exit()
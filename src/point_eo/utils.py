@@ -0,0 +1,238 @@
+"""
+Helpers shared by the point-eo scripts
+"""
+
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+
+def save_model(model, model_file):
+    """
+    Saves the model with joblib without compression, so that its large arrays can
+    be memory-mapped when the model is loaded.
+    """
+    joblib.dump(model, model_file)
+
+
+def load_model(model_file, mmap_mode="r"):
+    """
+    Loads a model saved with save_model or pickle. With `mmap_mode` the arrays of
+    models saved with save_model are memory-mapped read-only, so that processes
+    loading the same file share them through the page cache.
+    """
+    return joblib.load(model_file, mmap_mode=mmap_mode)
+
+
+class ArrayForest:
+    """
+    A fitted random forest as flat node arrays, predicting the same class
+    probabilities as the forest. scikit-learn copies the nodes of its trees into
+    each process that loads them, while the plain arrays of an ArrayForest saved
+    with save_model are memory-mapped by load_model and shared between processes.
+
+    The nodes of all trees follow each other. Row i of `children_` holds the
+    right and left child of node i, so a pixel moves to children_[i, x <= threshold].
+    Leaves point to themselves, so each tree is walked for its depth without
+    checking for leaves.
+    """
+
+    def __init__(self, forest):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        if trees[0].n_outputs != 1:
+            raise Exception("ArrayForest supports forests with a single output")
+        sizes = np.array([t.node_count for t in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        left = np.concatenate([t.children_left for t in trees]).astype(np.intp)
+        right = np.concatenate([t.children_right for t in trees]).astype(np.intp)
+        leaf = left == -1
+        nodes = np.arange(len(left))
+        shift = np.repeat(offsets, sizes)
+        self.children_ = np.stack(
+            [np.where(leaf, nodes, right + shift), np.where(leaf, nodes, left + shift)], axis=1
+        )
+        self.feature_ = np.where(
+            leaf, 0, np.concatenate([t.feature for t in trees])
+        ).astype(np.intp)
+        self.threshold_ = np.where(
+            leaf, np.inf, np.concatenate([t.threshold for t in trees])
+        )
+        value = np.concatenate([t.value[:, 0, :] for t in trees])
+        self.value_ = value / value.sum(axis=1, keepdims=True)
+        self.roots_ = offsets.astype(np.intp)
+        self.depths_ = np.array([t.max_depth for t in trees])
+
+        self.n_estimators = len(trees)
+        self.classes_ = forest.classes_
+        self.n_features_in_ = forest.n_features_in_
+        for name in ("feature_names_in_", "band_names_", "halo_"):
+            if hasattr(forest, name):
+                setattr(self, name, getattr(forest, name))
+
+    def __repr__(self):
+        return f"ArrayForest({self.n_estimators} trees, {len(self.value_)} nodes)"
+
+    def tree_proba(self, X):
+        """Class probabilities of each tree for the (sample, feature) array X, tree by tree"""
+        X = np.ascontiguousarray(X, dtype="float32")
+        values = X.ravel()
+        row_start = np.arange(len(X)) * X.shape[1]
+        children = self.children_.ravel()
+        for root, depth in zip(self.roots_, self.depths_):
+            node = np.full(len(X), root)
+            for _ in range(depth):
+                go_left = values[row_start + self.feature_[node]] <= self.threshold_[node]
+                node = children[2 * node + go_left]
+            yield self.value_[node]
+
+    def predict_proba(self, X):
+        P = np.zeros((len(X), len(self.classes_)))
+        for p in self.tree_proba(X):
+            P += p
+        return P / self.n_estimators
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def block_windows(height, width, block_size):
+    """Windows of `block_size` x `block_size` pixels covering a raster, row by row"""
+    from rasterio.windows import Window
+
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(
+                col, row, min(block_size, width - col), min(block_size, height - row)
+            )
+
+
+def available_memory():
+    """Available system memory in bytes, or None if it cannot be measured"""
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def downcast_features(df):
+    """
+    Stores the bands of a training table (all but the first column) compactly:
+    integer bands in the smallest integer type holding their values (uint16 for
+    sampled reflectances) and floating point bands as float32
+    """
+    df = df.copy()
+    for col in df.columns[1:]:
+        s = df[col]
+        if pd.api.types.is_integer_dtype(s):
+            downcast = "unsigned" if s.min() >= 0 else "integer"
+            df[col] = pd.to_numeric(s, downcast=downcast)
+        elif pd.api.types.is_float_dtype(s):
+            df[col] = s.astype("float32")
+    return df
+
+
+def read_training_csv(input_file, sep=",", decimal=".", usecols=None, chunksize=100_000):
+    """
+    Reads a training table in chunks of `chunksize` rows, downcasting the bands
+    of each chunk, so that the whole table is never held as int64 or float64.
+    The columns are in the order of `usecols` if given, and the index is the
+    row number in the file.
+    """
+    reader = pd.read_csv(
+        input_file, sep=sep, decimal=decimal, usecols=usecols, chunksize=chunksize
+    )
+    chunks = [downcast_features(chunk) for chunk in reader]
+    if not chunks:
+        df = pd.read_csv(input_file, sep=sep, decimal=decimal, usecols=usecols, nrows=0)
+    else:
+        # Chunks of different integer types are upcast to a common type
+        df = pd.concat(chunks)
+    if usecols is not None:
+        df = df[usecols]
+    return df
+
+
+def feature_matrix(dfX, max_memory=None):
+    """
+    The features as a float32 C-contiguous array, the layout the tree models of
+    scikit-learn use internally, so that fitting and predicting do not copy it.
+    Raises before converting if the array does not fit to `max_memory` (MB), by
+    default the available memory.
+    """
+    nbytes = dfX.shape[0] * dfX.shape[1] * np.dtype("float32").itemsize
+    limit = max_memory * 1024**2 if max_memory is not None else available_memory()
+    if limit is not None and nbytes > limit:
+        raise Exception(
+            f"The feature array of {dfX.shape[0]} rows and {dfX.shape[1]} bands needs "
+            f"{nbytes / 1024**2:.1f} MB, but only {limit / 1024**2:.1f} MB is "
+            "available. Use --max_per_class or fewer bands"
+        )
+    return np.ascontiguousarray(dfX.to_numpy(dtype="float32"))
+
+
+def stratified_sample(
+    y,
+    fraction=1.0,
+    min_per_class=5,
+    random_state=42,
+    max_per_class=None,
+    coords=None,
+    thin_distance=None,
+):
+    """
+    Sorted row indices of a sample of `fraction` of the rows of each class of `y`,
+    at least `min_per_class` rows of each class (or all of its rows) and at most
+    `max_per_class` rows. Samples of growing fractions or caps with the same
+    `random_state` are nested.
+
+    With `coords` (n, 2) and `thin_distance`, the rows are first thinned to one
+    random row of each class in each `thin_distance` grid cell, so that the
+    sample of a class spreads over its area instead of following its densest
+    clusters.
+    """
+    y = np.asarray(y)
+    rng = np.random.default_rng(random_state)
+    _, codes = np.unique(y, return_inverse=True)
+    codes = codes.ravel()
+    order = rng.permutation(len(y))
+
+    if thin_distance is not None:
+        cells = np.floor(np.asarray(coords, dtype=float) / thin_distance).astype("int64")
+        keys = np.column_stack([codes[order], cells[order]])
+        # The first row of each (class, cell) in the random order
+        _, first = np.unique(keys, axis=0, return_index=True)
+        order = order[np.sort(first)]
+
+    # Random order within each class, classes one after another
+    order = order[np.argsort(codes[order], kind="stable")]
+    counts = np.bincount(codes[order], minlength=codes.max(initial=-1) + 1)
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    n = np.maximum(min_per_class, np.round(fraction * counts).astype("int64"))
+    if max_per_class is not None:
+        n = np.minimum(n, max_per_class)
+    return np.sort(order[rank < n[codes[order]]])
+
+
+def cap_classes(dfX, dfY, max_per_class, random_state=42, rows_file=None):
+    """
+    At most `max_per_class` random rows of each class of a training table. With
+    `rows_file`, the index labels of the selected rows are saved there one per
+    line, so that the sample can be reproduced.
+    """
+    rows = stratified_sample(
+        dfY.to_numpy(), max_per_class=max_per_class, random_state=random_state
+    )
+    dfX, dfY = dfX.iloc[rows], dfY.iloc[rows]
+    if rows_file is not None:
+        np.savetxt(rows_file, dfY.index.to_numpy(), fmt="%s")
+    return dfX, dfY
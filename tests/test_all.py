@@ -1,6 +1,7 @@
 import pytest
 import argparse
-from point_eo.scripts import sample_raster, feature_selection, analysis, tpot_train, predict, set_band_description, postprocess_prediction
+from point_eo.scripts import sample_raster, feature_selection, analysis, tpot_train, predict, set_band_description, postprocess_prediction, zonal_stats
+
 
 def get_parser():
     parser = argparse.ArgumentParser(prog="point-eo")
@@ -12,8 +13,25 @@ def get_parser():
     predict.add_args(subparsers)
     set_band_description.add_args(subparsers)
     postprocess_prediction.add_args(subparsers)
+    zonal_stats.add_args(subparsers)
     return parser
 
+
+def test_cli_lazy_import():
+    import subprocess
+    import sys
+    # The help of a command exits the interpreter after building its parser
+    code = ("import sys\n"
+            "from point_eo import cli\n"
+            "try:\n"
+            "    cli.main(['predict', '--help'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "heavy = {'tpot', 'dask', 'rioxarray', 'rasterio', 'geopandas', 'sklearn', 'osgeo'}\n"
+            "assert not heavy & set(sys.modules), heavy & set(sys.modules)")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
 def test_sample_raster():
     test_args = ["sample_raster",
                  "--input", "data/points_clc.geojson",
@@ -24,6 +42,39 @@ def test_sample_raster():
     args = parser.parse_args(test_args)
     sample_raster.main(args)
 
+
+def test_sample_raster_cache():
+    import geopandas as gpd
+    test_args = ["sample_raster",
+                 "--input", "data/points_clc.geojson",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--target", "corine",
+                 "--cache_dir", "test_project/sample_cache",
+                 "--out_folder", "test_project/samples_cached"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    sample_raster.main(args)
+    # Second run reads all points from the cache
+    sample_raster.main(args)
+    gdf = gpd.read_file("data/points_clc.geojson")
+    cache = sample_raster.FeatureCache("test_project/sample_cache")
+    sample_raster.sample_points(gdf, "data/s2_2018_lataseno.tif", "corine", cache=cache)
+    assert cache.hits == len(gdf) and cache.misses == 0
+
+
+def test_sample_raster_max_per_class():
+    test_args = ["sample_raster",
+                 "--input", "data/points_clc.geojson",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--target", "corine",
+                 "--max_per_class", "50",
+                 "--thin_distance", "200",
+                 "--out_folder", "test_project/samples_thinned"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    sample_raster.main(args)
+
+
 def test_analysis():
     test_args = ["analysis",
                  "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
@@ -36,6 +87,7 @@ def test_analysis():
     args = parser.parse_args(test_args)
     analysis.main(args)
 
+
 def test_analysis_save_permutation_importance():
     test_args = ["analysis",
                  "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
@@ -49,6 +101,59 @@ def test_analysis_save_permutation_importance():
     args = parser.parse_args(test_args)
     analysis.main(args)
 
+
+def test_analysis_max_per_class():
+    test_args = ["analysis",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "demo_rf_capped",
+                 "--out_folder", "test_project/analysis_capped",
+                 "--separator", ",",
+                 "--decimal", ".",
+                 "--remove_classes_smaller_than", "6",
+                 "--max_per_class", "100",
+                 "--sample_seed", "1"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    analysis.main(args)
+
+
+def test_analysis_no_plots():
+    test_args = ["analysis",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "demo_rf_no_plots",
+                 "--out_folder", "test_project/analysis",
+                 "--separator", ",",
+                 "--decimal", ".",
+                 "--remove_classes_smaller_than", "6",
+                 "--no_plots"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    analysis.main(args)
+
+
+def test_analysis_grid_search():
+    import pandas as pd
+    from pathlib import Path
+    test_args = ["analysis",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "demo_rf_grid",
+                 "--out_folder", "test_project/analysis_grid",
+                 "--separator", ",",
+                 "--decimal", ".",
+                 "--remove_classes_smaller_than", "6",
+                 "--n_estimators", "20", "50",
+                 "--max_depth", "None", "5",
+                 "--random_seed", "0"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    analysis.main(args)
+    # The predictions of the best combination can be a tpot_train baseline
+    predictions = pd.read_csv(sorted(Path("test_project/analysis_grid").glob("demo_rf_grid__*_predictions.csv"))[-1])
+    assert {"y_true", "y_pred", "row", "fold"} <= set(predictions.columns)
+    leaderboard = pd.read_csv(sorted(Path("test_project/analysis_grid").glob("demo_rf_grid__*_leaderboard.csv"))[-1])
+    assert set(leaderboard["max_depth"].dropna()) == {5}
+
+
 def test_feature_selection():
     test_args = ["feature_selection",
                  "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
@@ -65,6 +170,54 @@ def test_feature_selection():
     args = parser.parse_args(test_args)
     feature_selection.main(args)
 
+
+def test_correlation_clusters():
+    import numpy as np
+    rng = np.random.default_rng(0)
+    a, b = rng.normal(size=(2, 500))
+    # Columns 0-2 follow a, column 3 follows b and column 4 is constant
+    X = np.column_stack([a, a + 0.01 * rng.normal(size=500), 2 * a, b, np.ones(500)])
+    corr = feature_selection.correlation_matrix(X, method="pearson", chunk_size=2)
+    assert np.allclose(corr[:4, :4], np.corrcoef(X[:, :4].T), atol=1e-5)
+    labels = feature_selection.correlation_clusters(corr, threshold=0.9)
+    assert labels[0] == labels[1] == labels[2]
+    assert len(set(labels[[0, 3, 4]])) == 3
+    representatives = feature_selection.cluster_representatives(corr, labels)
+    assert len(representatives) == 3 and {3, 4} <= set(representatives)
+    # A single feature is its own cluster
+    assert list(feature_selection.correlation_clusters(np.ones((1, 1)))) == [1]
+    assert list(feature_selection.cluster_representatives(np.ones((1, 1)), np.ones(1, dtype=int))) == [0]
+
+
+def test_feature_selection_correlation_pruning():
+    test_args = ["feature_selection",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "demo_pruned",
+                 "--out_folder", "test_project/feature_selection",
+                 "--separator", ",",
+                 "--decimal", ".",
+                 "--remove_classes_smaller_than", "6",
+                 "--correlation_pruning",
+                 "--correlation_threshold", "0.8"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    feature_selection.main(args)
+
+
+def test_analysis_bands():
+    test_args = ["analysis",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "demo_rf_bands",
+                 "--out_folder", "test_project/analysis",
+                 "--bands", "tests/data/analysis/bands.txt",
+                 "--separator", ",",
+                 "--decimal", ".",
+                 "--remove_classes_smaller_than", "6"]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    analysis.main(args)
+
+
 def test_tpot_train():
     test_args = ["tpot_train",
                  "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
@@ -78,6 +231,94 @@ def test_tpot_train():
     args = parser.parse_args(test_args)
     tpot_train.main(args)
 
+
+def test_tpot_train_resume():
+    # Continues the search of test_tpot_train for one more generation
+    test_args = ["tpot_train",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "tpot_demo",
+                 "--out_folder", "test_project/test_tpot",
+                 "--generations", "3",
+                 "--population_size", "10",
+                 "--scoring", "f1_weighted",
+                 "--max_time", "10",
+                 "--resume"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    tpot_train.main(args)
+
+
+def test_tpot_checkpoint_restore(tmp_path):
+    import json
+    import numpy as np
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(60, 4))
+    y = np.repeat([0, 1, 2], 20)
+    population = [
+        "GaussianNB(input_matrix)",
+        "BernoulliNB(input_matrix, BernoulliNB__alpha=1.0, BernoulliNB__fit_prior=True)",
+    ]
+    evaluated = {
+        pipeline: {"generation": 0, "mutation_count": 0, "crossover_count": 0,
+                   "predecessor": ["ROOT"], "operator_count": 1, "internal_cv_score": score}
+        for pipeline, score in zip(population, [0.99, 0.5])
+    }
+    checkpoint = tmp_path / "checkpoint.json"
+    with open(checkpoint, "w") as f:
+        json.dump({"data": tpot_train.data_checksum(X, y), "generations_done": 2,
+                   "population": population, "pareto_front": population[:1],
+                   "evaluated_individuals": evaluated}, f)
+
+    tpotC = tpot_train.CheckpointTPOTClassifier(population_size=2, random_state=42)
+    tpotC.load_checkpoint(checkpoint)
+    assert tpotC.generations_done == 2
+    assert [str(ind) for ind in tpotC._pop] == population
+    assert [str(ind) for ind in tpotC._pareto_front.items] == population[:1]
+
+    # Both generations are done, so the restored scores choose the pipeline without a search
+    tpotC = tpot_train.search_tpot(X, y, generations=2, population_size=2,
+                                   checkpoint_file=str(checkpoint), resume=True, n_jobs=1)
+    assert tpotC.generations == 0
+    assert str(tpotC._optimized_pipeline) == population[0]
+    assert tpotC.evaluated_individuals_[population[0]]["internal_cv_score"] == 0.99
+
+
+def test_tpot_train_successive_halving():
+    test_args = ["tpot_train",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "tpot_halving",
+                 "--out_folder", "test_project/test_tpot",
+                 "--generations", "2",
+                 "--population_size", "9",
+                 "--successive_halving",
+                 "--min_fraction", "0.3"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    tpot_train.main(args)
+
+
+def test_tpot_train_baseline_predictions():
+    # Reuses the random forest predictions of test_analysis as the baseline
+    from pathlib import Path
+    predictions = sorted(Path("test_project/analysis").glob("demo_rf__*_predictions.csv"))[-1]
+    test_args = ["tpot_train",
+                 "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
+                 "--out_prefix", "tpot_demo",
+                 "--out_folder", "test_project/test_tpot",
+                 "--generations", "3",
+                 "--population_size", "10",
+                 "--scoring", "f1_weighted",
+                 "--resume",
+                 "--n_jobs", "2",
+                 "--baseline_predictions", str(predictions)
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    tpot_train.main(args)
+
+
 def test_tpot_analysis():
     test_args = ["analysis",
                  "--input", "tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv",
@@ -91,6 +332,7 @@ def test_tpot_analysis():
     args = parser.parse_args(test_args)
     analysis.main(args)
 
+
 def test_predict_rf():
     test_args = ["predict",
                  "--model", "tests/data/models/demo_rf__s2_2018_lataseno__points_clc__corine__2024-12-09T17-04-59_model.pkl",
@@ -103,6 +345,7 @@ def test_predict_rf():
     args = parser.parse_args(test_args)
     predict.main(args)
 
+
 def test_predict_tpot_normal():
     test_args = ["predict",
                 "--model", "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
@@ -115,6 +358,181 @@ def test_predict_tpot_normal():
     args = parser.parse_args(test_args)
     predict.main(args)
 
+
+def test_predict_tpot_train_model():
+    from pathlib import Path
+    # Pipeline fitted and saved by test_tpot_train, without an analysis run
+    model = sorted(Path("test_project/test_tpot").glob("tpot_demo_acc*_model.pkl"))[-1]
+    test_args = ["predict",
+                "--model", str(model),
+                "--input_raster", "data/s2_2018_lataseno.tif",
+                "--cell_size", "3000",
+                "--out_folder", "test_project/predictions_tpot_train"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_auto_cell_size():
+    test_args = ["predict",
+                 "--model", "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "auto",
+                 "--memory_budget", "512",
+                 "--cell_buffer", "2",
+                 "--out_folder", "test_project/predictions_auto"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_profile_log():
+    test_args = ["predict",
+                 "--model", "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--cell_buffer", "2",
+                 "--profile_log", "test_project/predictions_profile/cells.jsonl",
+                 "--out_folder", "test_project/predictions_profile"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_model_bands():
+    from pathlib import Path
+    # Model trained on a subset of bands in test_analysis_bands
+    model = sorted(Path("test_project/analysis").glob("demo_rf_bands__*_model.pkl"))[-1]
+    test_args = ["predict",
+                 "--model", str(model),
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--cell_buffer", "2",
+                 "--out_folder", "test_project/predictions_bands"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_processes():
+    from pathlib import Path
+    model = sorted(Path("test_project/analysis").glob("demo_rf_bands__*_model.pkl"))[-1]
+    test_args = ["predict",
+                 "--model", str(model),
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--cell_buffer", "2",
+                 "--n_jobs", "2",
+                 "--processes",
+                 "--out_folder", "test_project/predictions_processes"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_dask_local():
+    test_args = ["predict",
+                 "--model", "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_buffer", "0",
+                 "--dask_scheduler", "local",
+                 "--n_jobs", "2",
+                 "--out_folder", "test_project/predictions_dask"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_halo():
+    test_args = ["predict",
+                 "--model", "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--halo", "2",
+                 "--out_folder", "test_project/predictions_halo"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_cell_window_covers_raster():
+    import numpy as np
+    import xarray as xr
+    import dask.array as da
+    # Cell sizes dividing the raster evenly end at the center of the last column
+    for ny, nx, res, cell_size in [(301, 301, 10, 1000), (51, 101, 10, 500), (64, 64, 20, 320)]:
+        x = 500000 + res / 2 + np.arange(nx) * res
+        y = 7000000 - res / 2 - np.arange(ny) * res
+        Fx = xr.DataArray(
+            da.ones((1, ny, nx)), coords={"band": [1], "y": y, "x": x}, dims=("band", "y", "x")
+        )
+        covered = np.zeros((ny, nx), dtype=int)
+        for cell in predict.make_cells(Fx, cell_size):
+            (ys, xs), _ = predict.cell_window(Fx, cell)
+            covered[ys, xs] += 1
+        assert (covered == 1).all()
+
+
+def test_predict_ensemble():
+    test_args = ["predict",
+                 "--model",
+                 "tests/data/models/demo_rf__s2_2018_lataseno__points_clc__corine__2024-12-09T17-04-59_model.pkl",
+                 "tests/data/models/tpot_demo__s2_2018_lataseno__points_clc__corine__2024-12-12T10-17-34_model.pkl",
+                 "--weights", "2", "1",
+                 "--ensemble_band", "entropy",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--out_folder", "test_project/predictions_ensemble"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_uncertainty():
+    test_args = ["predict",
+                 "--model", "tests/data/models/demo_rf__s2_2018_lataseno__points_clc__corine__2024-12-09T17-04-59_model.pkl",
+                 "--input_raster", "data/s2_2018_lataseno.tif",
+                 "--cell_size", "3000",
+                 "--uncertainty", "entropy", "margin", "variance",
+                 "--out_folder", "test_project/predictions_uncertainty"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+
+
+def test_predict_previous(monkeypatch):
+    import json
+    from pathlib import Path
+    # Same raster as in test_predict_rf, so all cells are reused, also when
+    # started from another directory
+    root = Path.cwd()
+    name = "s2_2018_lataseno__demo_rf__s2_2018_lataseno__points_clc__corine__2024-12-09T17-04-59_model_manifest.json"
+    monkeypatch.chdir(root / "test_project")
+    test_args = ["predict",
+                 "--model", str(root / "tests/data/models/demo_rf__s2_2018_lataseno__points_clc__corine__2024-12-09T17-04-59_model.pkl"),
+                 "--input_raster", str(root / "data/s2_2018_lataseno.tif"),
+                 "--cell_size", "3000",
+                 "--previous", str(root / "test_project/predictions" / name),
+                 "--out_folder", "predictions_previous"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    predict.main(args)
+    with open(Path("predictions_previous") / name) as f:
+        cells = json.load(f)["cells"]
+    assert not any(cell["status"] == "saved" for cell in cells)
+    assert all(Path(f).is_absolute() for cell in cells for f in cell["files"].values())
+
+
 def test_predict_tpot_try_overwrite():
     from pathlib import Path
     dir = Path("test_project/predictions_overwrite/s2_2018_lataseno_patches")
@@ -134,6 +552,7 @@ def test_predict_tpot_try_overwrite():
     assert e.type == SystemExit
     assert e.value.code == 1
 
+
 def test_set_band_description():
     test_args = ["set_band_description",
                  "--input_raster", "tests/data/predictions/demo.tif",
@@ -143,6 +562,7 @@ def test_set_band_description():
     args = parser.parse_args(test_args)
     set_band_description.main(args)
 
+
 def test_postprocess_prediction():
     test_args = ["postprocess_prediction",
                  "--input_raster", "tests/data/predictions/demo.tif",
@@ -151,4 +571,125 @@ def test_postprocess_prediction():
     ]
     parser = get_parser()
     args = parser.parse_args(test_args)
-    postprocess_prediction.main(args)
\ No newline at end of file
+    postprocess_prediction.main(args)
+
+
+def test_postprocess_prediction_blocks():
+    test_args = ["postprocess_prediction",
+                 "--input_raster", "tests/data/predictions/demo.tif",
+                 "--out_folder", "test_project/predictions_blocks",
+                 "--block_size", "256",
+                 "--n_jobs", "2"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    postprocess_prediction.main(args)
+
+
+def test_postprocess_prediction_color_table():
+    import rasterio
+    test_args = ["postprocess_prediction",
+                 "--input_raster", "tests/data/predictions/demo.tif",
+                 "--out_folder", "test_project/predictions_color_table",
+                 "--label_map", "tests/data/analysis/label_map.txt"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    postprocess_prediction.main(args)
+    with rasterio.open("test_project/predictions_color_table/demo_S.tif") as src:
+        assert src.descriptions == ("class",)
+        assert len(src.colormap(1)) > 0
+
+
+def test_zonal_stats():
+    import geopandas as gpd
+    import pandas as pd
+    from pathlib import Path
+    Path("test_project/zonal_stats").mkdir(parents=True, exist_ok=True)
+    points = gpd.read_file("tests/data/analysis/s2_2018_lataseno__points_clc__corine.geojson")
+    points.assign(geometry=points.buffer(100)).to_file("test_project/zonal_stats/polygons.geojson")
+    labels = [f"class_{k}" for k in range(256)]
+    with open("test_project/zonal_stats/label_map.txt", "w") as f:
+        f.write("\n".join(labels) + "\n\n")
+    test_args = ["zonal_stats",
+                 "--input_raster", "test_project/predictions/demo_S.tif",
+                 "--confidence_raster", "test_project/predictions/demo_M.tif",
+                 "--polygons", "test_project/zonal_stats/polygons.geojson",
+                 "--label_map", "test_project/zonal_stats/label_map.txt",
+                 "--output", "test_project/zonal_stats/zonal_stats.csv"
+    ]
+    parser = get_parser()
+    args = parser.parse_args(test_args)
+    zonal_stats.main(args)
+    stats = pd.read_csv("test_project/zonal_stats/zonal_stats.csv", index_col=0)
+    counts = stats.filter(like="count_")
+    assert len(stats) == len(points) and len(counts.columns) > 0
+    assert set(counts.columns) <= {f"count_{label}" for label in labels}
+    assert (counts.sum(axis=1) == stats["pixels"]).all()
+    covered = stats["pixels"] > 0
+    assert (stats["majority"][covered] == counts[covered].idxmax(axis=1).str[len("count_"):]).all()
+    assert stats["majority"][~covered].isna().all()
+
+
+def test_zonal_stats_without_confidence():
+    import geopandas as gpd
+    import pandas as pd
+    # S has no nodata value, so without M the value to skip must be given
+    polygons = gpd.read_file("test_project/zonal_stats/polygons.geojson")
+    polygons.assign(majority="old").to_file("test_project/zonal_stats/polygons_majority.geojson")
+    test_args = ["zonal_stats",
+                 "--input_raster", "test_project/predictions/demo_S.tif",
+                 "--polygons", "test_project/zonal_stats/polygons_majority.geojson",
+                 "--output", "test_project/zonal_stats/zonal_stats.gpkg"
+    ]
+    parser = get_parser()
+    with pytest.raises(Exception, match="--nodata"):
+        zonal_stats.main(parser.parse_args(test_args))
+    zonal_stats.main(parser.parse_args(test_args + ["--nodata", "-1"]))
+    stats = gpd.read_file("test_project/zonal_stats/zonal_stats.gpkg")
+    assert (stats["majority"] == "old").all() and "majority_zonal" in stats.columns
+    # All pixels are counted, including the pixels of class 0
+    with_confidence = pd.read_csv("test_project/zonal_stats/zonal_stats.csv", index_col=0)
+    assert (stats["pixels"].to_numpy() >= with_confidence["pixels"].to_numpy()).all()
+
+
+def test_api_in_memory():
+    import geopandas as gpd
+    from point_eo import api
+    gdf, df = api.sample_points(gpd.read_file("data/points_clc.geojson"), "data/s2_2018_lataseno.tif", "corine")
+    dfX, dfY = api.split_table(df)
+    dfX, dfY, _ = api.remove_small_classes(dfX, dfY, 6)
+    X, y = dfX.to_numpy(), dfY.to_numpy()
+    y_true, y_pred, importances, _ = api.cross_validate(api.build_rf, X, y, dfX.columns, n_splits=3)
+    assert len(y_true) == len(y_pred) == len(y)
+    model = api.fit_model(api.build_rf(), X, y, dfX.columns)
+    Fx = api.prepare_raster(model, "data/s2_2018_lataseno.tif")
+    probabilities = api.predict_array(model, Fx[:, :100, :100])
+    assert probabilities.shape == (len(model.classes_), 100, 100)
+
+
+def test_api_read_training_csv():
+    import numpy as np
+    from point_eo import api
+    df = api.read_training_csv("tests/data/analysis/s2_2018_lataseno__points_clc__corine.csv", chunksize=100)
+    assert (df.dtypes.iloc[1:] == "uint16").all()
+    assert df.index[-1] == len(df) - 1
+    X = api.feature_matrix(df.iloc[:, 1:])
+    assert X.dtype == np.float32 and X.flags.c_contiguous
+    with pytest.raises(Exception):
+        api.feature_matrix(df.iloc[:, 1:], max_memory=0.001)
+
+
+def test_api_array_forest():
+    import numpy as np
+    from sklearn.ensemble import RandomForestClassifier
+    from point_eo import api
+    rng = np.random.default_rng(0)
+    X = rng.random((500, 4)).astype("float32")
+    y = (X[:, 0] * 3).astype(int)
+    forest = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+    api.save_model(api.ArrayForest(forest), "test_project/array_forest.pkl")
+    model = api.load_model("test_project/array_forest.pkl")
+    # The node arrays are memory-mapped, not copied to the process
+    assert isinstance(model.children_, np.memmap)
+    assert np.allclose(model.predict_proba(X), forest.predict_proba(X))